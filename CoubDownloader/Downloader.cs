@@ -132,14 +132,6 @@ namespace CoubDownloader
 
         private void EnsureInput(string dir)
         {
-            // coub_v2.py is creating temp list for data
-            // It might be left behind if something happens, clean that up before starting
-            var tmpList = Path.Combine(Environment.CurrentDirectory, "list.txt");
-            if (File.Exists(tmpList))
-            {
-                File.Delete(tmpList);
-            }
-            
             // Main coub directory
             if (!Directory.Exists(coubsDir))
             {
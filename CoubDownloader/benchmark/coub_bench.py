@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark for coub_v2.py
+
+Starts a local mock of the Coub API and media CDN, runs coub_v2.py
+against it for a few representative scenarios and reports throughput.
+Nothing in here talks to coub.com.
+
+Usage: coub_bench.py [OPTIONS] [-- EXTRA_COUB_V2_ARGS]
+"""
+
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# Reuse a few helpers of the script under test
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(SCRIPT_DIR, "coub_v2.py")
+sys.path.insert(0, SCRIPT_DIR)
+from coub_v2 import parse_size, format_size
+
+# Same value as coub_v2's Options.coubs_per_page
+PER_PAGE = 25
+
+# Stages the mock server keeps track of
+STAGES = ("timeline", "coub", "media")
+
+# Stages coub_v2.py reports with --metrics
+CLIENT_STAGES = ("api", "video", "audio", "merge", "archive")
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Mock server
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class ServerStats:
+    """Request counters of the mock server (shared by all handler threads)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = dict.fromkeys(STAGES, 0)
+            # Time spent answering requests (summed over all connections)
+            self.busy = dict.fromkeys(STAGES, 0.0)
+            self.bytes = 0
+            self.errors = 0
+            self.throttled = 0
+            self.connections = 0
+            self.first_media = None
+            self.last_media = None
+            # Requests of a previous run may still finish after a reset
+            self.since = time.monotonic()
+
+    def record(self, stage, start, end, sent):
+        with self.lock:
+            if start < self.since:
+                return
+            self.requests[stage] += 1
+            self.busy[stage] += end - start
+            self.bytes += sent
+            if stage == "media":
+                if self.first_media is None or start < self.first_media:
+                    self.first_media = start
+                if self.last_media is None or end > self.last_media:
+                    self.last_media = end
+
+    def count(self, attr):
+        with self.lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Serves a synthetic subset of the Coub API
+
+    /api/v2/timeline/{channel,tag}/NAME  -> timeline pages
+    /api/v2/search/coubs?q=TERM          -> timeline pages
+    /api/v2/coubs/ID                     -> coub metadata
+    /media/ID/QUALITY.EXT                -> generated MP4/MP3 files
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.stats.count("connections")
+
+    def send_body(self, status, body, ctype, headers=()):
+        """Send a response, honouring the configured bandwidth"""
+
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+
+        rate = self.server.bandwidth
+        if not rate:
+            self.wfile.write(body)
+            return len(body)
+
+        chunk = max(int(rate / 20), 1024)
+        start = time.monotonic()
+        for pos in range(chunk, len(body) + chunk, chunk):
+            self.wfile.write(body[pos-chunk:pos])
+            ahead = min(pos, len(body)) / rate - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+        return len(body)
+
+    def do_GET(self):
+        start = time.monotonic()
+        server = self.server
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if url.path.startswith(("/api/v2/timeline/", "/api/v2/search/")):
+            stage = "timeline"
+        elif url.path.startswith("/api/v2/coubs/"):
+            stage = "coub"
+        elif url.path.startswith("/media/") and len(parts) == 3:
+            stage = "media"
+        else:
+            self.send_body(404, b"{}", "application/json")
+            return
+
+        with server.lock:
+            roll = server.rng.random()
+        if roll < server.throttle_rate:
+            server.stats.count("throttled")
+            sent = self.send_body(429, b"{}", "application/json", [("Retry-After", "1")])
+        # Broken timeline pages would only abort the run
+        elif stage != "timeline" and roll < server.throttle_rate + server.error_rate:
+            server.stats.count("errors")
+            sent = self.send_body(500, b"{}", "application/json")
+        elif stage == "timeline":
+            sent = self.timeline(parse_qs(url.query))
+        elif stage == "coub":
+            sent = self.coub(parts[-1])
+        else:
+            sent = self.media(parts[1], parts[2])
+        server.stats.record(stage, start, time.monotonic(), sent)
+
+    def timeline(self, query):
+        server = self.server
+        per_page = int(query.get("per_page", [PER_PAGE])[0])
+        page = int(query.get("page", [1])[0])
+        pages = (server.coubs + per_page - 1) // per_page
+        first = (page - 1) * per_page
+        items = [coub_json(i, server.cdn_url)
+                 for i in range(first, min(first + per_page, server.coubs))]
+        body = json.dumps({'page': page, 'total_pages': pages, 'coubs': items})
+        return self.send_body(200, body.encode(), "application/json")
+
+    def coub(self, c_id):
+        try:
+            body = json.dumps(coub_json(int(c_id[1:]), self.server.cdn_url))
+        except ValueError:
+            return self.send_body(404, b"{}", "application/json")
+        return self.send_body(200, body.encode(), "application/json")
+
+    def media(self, c_id, version):
+        ext = version.rsplit(".", 1)[-1]
+        body = self.server.media.get(ext)
+        if body is None:
+            return self.send_body(404, b"", "text/plain")
+        ctype = "video/mp4" if ext == "mp4" else "audio/mpeg"
+
+        rng = self.headers.get("Range")
+        if rng and rng.startswith("bytes="):
+            start = int(rng[6:].split("-")[0] or 0)
+            if start >= len(body):
+                return self.send_body(416, b"", ctype,
+                                      [("Content-Range", "bytes */" + str(len(body)))])
+            content_range = "bytes {0}-{1}/{2}".format(start, len(body) - 1, len(body))
+            return self.send_body(206, body[start:], ctype, [("Content-Range", content_range)])
+        return self.send_body(200, body, ctype)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class MockServer(ThreadingHTTPServer):
+    """Mock API/CDN server with configurable network conditions"""
+
+    daemon_threads = True
+
+    def __init__(self, media, stats, args):
+        super().__init__(("127.0.0.1", 0), MockHandler)
+        self.media = media
+        self.stats = stats
+        self.coubs = args.coubs
+        self.latency = args.latency / 1000
+        self.bandwidth = parse_size(args.bandwidth) if args.bandwidth else None
+        self.error_rate = args.error_rate
+        self.throttle_rate = args.throttle_rate
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        # Set by start_servers, media links point there
+        self.cdn_url = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Functions
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def coub_id(i):
+    """Synthetic coub ID for index i"""
+    return "b{0:06d}".format(i)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def coub_json(i, cdn_url):
+    """Synthetic metadata in the shape of the Coub API"""
+
+    c_id = coub_id(i)
+    base = cdn_url + "/media/" + c_id + "/"
+    return {
+        'permalink': c_id,
+        'title': "Benchmark coub #{0}: it's (probably) fine".format(i),
+        'created_at': "2020-01-01T00:00:00Z",
+        'channel': {'title': "bench"},
+        'categories': [{'title': "bench"}],
+        'tags': [{'title': "bench"}, {'title': "mock"}],
+        'recoub_to': None,
+        'file_versions': {
+            'html5': {
+                'video': {'med': {'url': base + "med.mp4", 'size': 1},
+                          'high': {'url': base + "high.mp4", 'size': 1}},
+                'audio': {'med': {'url': base + "med.mp3", 'size': 1},
+                          'high': {'url': base + "high.mp3", 'size': 1}},
+            },
+            'mobile': {'audio': [base + "mobile.mp3"]},
+        },
+    }
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def make_media(ffmpeg, tmp_dir, duration):
+    """Generate a small MP4 video and a longer MP3 audio track"""
+
+    video = os.path.join(tmp_dir, "video.mp4")
+    audio = os.path.join(tmp_dir, "audio.mp3")
+    subprocess.run([ffmpeg, "-y", "-v", "error",
+                    "-f", "lavfi", "-i", "testsrc=size=320x180:rate=25",
+                    "-t", "1", "-c:v", "mpeg4", "-q:v", "5", video], check=True)
+    subprocess.run([ffmpeg, "-y", "-v", "error",
+                    "-f", "lavfi", "-i", "sine=frequency=440",
+                    "-t", str(duration), "-c:a", "libmp3lame", "-b:a", "128k", audio],
+                   check=True)
+
+    media = {}
+    for ext, path in (("mp4", video), ("mp3", audio)):
+        with open(path, "rb") as f:
+            media[ext] = f.read()
+    return media
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def start_servers(media, stats, args):
+    """Start API and CDN servers on separate ports (like coub.com and its CDN)"""
+
+    api = MockServer(media, stats, args)
+    cdn = MockServer(media, stats, args)
+    api.cdn_url = cdn.cdn_url = cdn.url
+    for server in (api, cdn):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return api, cdn
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def scenarios(n, archived_share):
+    """
+    Representative workloads
+
+    Every scenario is a list of runs with (coub_v2 args, setup function).
+    Runs of one scenario share their working directory.
+    Coubs skipped via the archive don't count as processed, so
+    'archived' exits with code 4 (like any real run with archived coubs).
+    """
+
+    links = ["https://coub.com/view/" + coub_id(i) for i in range(n)]
+    archived = links[:int(n * archived_share)]
+
+    def write_list(work):
+        with open(os.path.join(work, "list.txt"), "w") as f:
+            print(*links, sep="\n", file=f)
+        with open(os.path.join(work, "archive.txt"), "w") as f:
+            for link in archived:
+                print(link.split("/")[-1], file=f)
+
+    return {
+        'channel': [(["-c", "bench"], None)],
+        'archived': [(["-l", "list.txt", "--use-archive", "archive.txt"], write_list)],
+        'custom-format': [(["-c", "bench", "-o", "%id%_%title%"], None),
+                          (["-c", "bench", "-o", "%id%_%title%"], None)],
+    }
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def run_coub(args, work, api_url, ffmpeg_dir, log, metrics_file):
+    """Run coub_v2.py in work and return (exit code, wall time, start time, metrics)"""
+
+    env = dict(os.environ)
+    if ffmpeg_dir:
+        env['PATH'] = ffmpeg_dir + os.pathsep + env.get('PATH', "")
+    command = [sys.executable, SCRIPT, "-y", "--api-url", api_url, "-p", work,
+               "--metrics", metrics_file] + args
+
+    start = time.monotonic()
+    result = subprocess.run(command, cwd=work, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.monotonic() - start
+
+    try:
+        with open(metrics_file, encoding="utf-8") as f:
+            metrics = json.load(f)
+    except (OSError, ValueError):
+        metrics = None
+    return (result.returncode, wall, start, metrics)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def report(name, n, status, wall, started, stats, metrics):
+    """Summarize one run"""
+
+    api_calls = stats.requests['timeline'] + stats.requests['coub']
+    result = {
+        'scenario': name,
+        'exit_code': status,
+        'coubs': n,
+        'wall': wall,
+        'coubs_per_sec': n / wall,
+        'bytes': stats.bytes,
+        'bytes_per_sec': stats.bytes / wall,
+        'api_calls_per_coub': api_calls / n,
+        'requests': dict(stats.requests),
+        'connections': stats.connections,
+        'throttled': stats.throttled,
+        'errors': stats.errors,
+        # Server-side view of the stages (summed over parallel requests)
+        'stage_busy': dict(stats.busy),
+        # Until the first media request, i.e. startup and metadata
+        'time_to_first_media': None,
+        # After the last media request, i.e. the last merges and shutdown
+        'tail': None,
+        # Client-side view of the stages (summed over parallel jobs)
+        'stages': dict.fromkeys(CLIENT_STAGES),
+        'retries': None,
+    }
+    if metrics:
+        totals = metrics['totals']
+        result['stages'] = {stage: totals[stage] for stage in CLIENT_STAGES}
+        result['retries'] = totals['retries']
+    if stats.first_media is not None:
+        result['time_to_first_media'] = stats.first_media - started
+        result['tail'] = started + wall - stats.last_media
+    return result
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def print_results(results):
+    """Print results as a table"""
+
+    def sec(value):
+        return "-" if value is None else "{0:.2f}s".format(value)
+
+    row = "{0:<18} {1:>4} {2:>8} {3:>9} {4:>11} {5:>8}" + \
+          "".join(" {" + str(i) + ":>8}" for i in range(6, 6 + len(CLIENT_STAGES) + 2))
+    print(row.format("scenario", "exit", "wall", "coubs/s", "bytes/s", "api/coub",
+                     *CLIENT_STAGES, "1st media", "tail"))
+    for r in results:
+        print(row.format(r['scenario'], r['exit_code'], sec(r['wall']),
+                         "{0:.1f}".format(r['coubs_per_sec']),
+                         format_size(r['bytes_per_sec']) + "/s",
+                         "{0:.2f}".format(r['api_calls_per_coub']),
+                         *(sec(r['stages'][stage]) for stage in CLIENT_STAGES),
+                         sec(r['time_to_first_media']), sec(r['tail'])))
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def parse_cli():
+    """Parse command line"""
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark coub_v2.py against a local mock of the Coub API/CDN.",
+        epilog="Arguments after '--' get passed on to coub_v2.py (e.g. -- -j 4 --api-rate 50).")
+    parser.add_argument("-n", "--coubs", type=int, default=100,
+                        help="coubs per scenario (default: %(default)s)")
+    parser.add_argument("-s", "--scenario", action="append",
+                        choices=["channel", "archived", "custom-format"],
+                        help="only run the given scenario (repeatable, default: all)")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="added latency per request in ms (default: %(default)s)")
+    parser.add_argument("--bandwidth", metavar="RATE",
+                        help="bandwidth per response in bytes/sec (suffixes K, M, G)")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="share of metadata/media requests failing with HTTP 500")
+    parser.add_argument("--throttle-rate", type=float, default=0,
+                        help="share of requests answered with HTTP 429")
+    parser.add_argument("--archived-share", type=float, default=0.9,
+                        help="share of archived coubs in the 'archived' scenario (default: %(default)s)")
+    parser.add_argument("--audio-duration", type=float, default=10,
+                        help="length of the generated audio in sec (default: %(default)s)")
+    parser.add_argument("--ffmpeg", default=shutil.which("ffmpeg"),
+                        help="ffmpeg binary (default: from PATH)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for error/429 injection (default: %(default)s)")
+    parser.add_argument("--keep-dirs", action="store_true",
+                        help="keep the working directories for inspection")
+    parser.add_argument("--json", metavar="FILE",
+                        help="also write the results as JSON to FILE")
+    parser.add_argument("extra", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.extra and args.extra[0] == "--":
+        args.extra = args.extra[1:]
+    if args.coubs <= 0:
+        parser.error("--coubs must be greater than zero")
+    if not args.ffmpeg:
+        parser.error("ffmpeg not found, use --ffmpeg")
+    return args
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Main Function
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def main():
+    """Main function body"""
+
+    args = parse_cli()
+    ffmpeg = os.path.abspath(args.ffmpeg)
+    root = tempfile.mkdtemp(prefix="coub_bench_")
+
+    try:
+        media = make_media(ffmpeg, root, args.audio_duration)
+        stats = ServerStats()
+        api, cdn = start_servers(media, stats, args)
+
+        results = []
+        for name, runs in scenarios(args.coubs, args.archived_share).items():
+            if args.scenario and name not in args.scenario:
+                continue
+            work = os.path.join(root, name)
+            os.mkdir(work)
+            for i, (coub_args, setup) in enumerate(runs, 1):
+                if setup:
+                    setup(work)
+                label = name if len(runs) == 1 else name + " #" + str(i)
+                print("Running ", label, "...", sep="", file=sys.stderr)
+
+                stats.reset()
+                metrics_file = os.path.join(work, "metrics" + str(i) + ".json")
+                with open(os.path.join(work, "run" + str(i) + ".log"), "w") as log:
+                    status, wall, started, metrics = run_coub(
+                        coub_args + args.extra, work, api.url,
+                        os.path.dirname(ffmpeg), log, metrics_file)
+                results.append(report(label, args.coubs, status, wall, started,
+                                      stats, metrics))
+                if status:
+                    print("  coub_v2.py exited with ", status, " (see ", log.name, ")",
+                          sep="", file=sys.stderr)
+
+        print_results(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if args.keep_dirs:
+            print("Working directories kept in", root, file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -3,22 +3,49 @@
 import sys
 import os
 import time
+import errno
 import json
 import random
+import hashlib
 import subprocess
+import re
+import shutil
+import queue
+import threading
+import socketserver
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from contextlib import contextmanager, nullcontext
 from fnmatch import fnmatch
 
+import io
+import gzip
+import base64
+import cProfile
+import pstats
+import http.client
 import urllib.error
 import urllib.request
-from urllib.request import urlopen, urlretrieve
 from urllib.parse import quote as urlquote
+from urllib.parse import unquote, urljoin, urlsplit
+from email.utils import parsedate_to_datetime
 import os, ssl
 
+# File locking (platform dependent)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
 if (not os.environ.get('PYTHONHTTPSVERIFY', '') and getattr(ssl, '_create_unverified_context', None)):
     ssl._create_default_https_context = ssl._create_unverified_context
 
 # TODO
-# -) implement --limit-rate
 # -) look out for new API changes
 
 # Error codes
@@ -33,6 +60,51 @@ err_stat = {'dep': 1,
             'down': 4,
             'int': 5}
 
+# Unfinished merge outputs, removed by clean() on early exits
+temp_files = set()
+
+# Keeps output of parallel threads from mixing within a line
+print_lock = threading.Lock()
+
+# Metrics instance (only with --metrics, see timed/count)
+metrics = None
+
+# Profiler instance (only with --profile, see ffmpeg_wait)
+profiler = None
+
+# JobState instance (only with --state, see mark)
+checkpoint = None
+
+# Progress callback of the current server job (see serve_job, mark)
+events = None
+
+# Objects kept alive between server jobs (see reuse)
+shared = {}
+
+# Coub titles contain characters that break filenames (e.g. ' or newlines)
+title_table = str.maketrans({"'": None, "\n": " ", "\r": " ",
+                             "/": None, "?": None, "|": None,
+                             "*": None, "<": None, ">": None,
+                             ")": None, "(": None, ":": None,
+                             "\\": None, "\"": None})
+
+# FFmpeg time duration syntax (see check_options)
+# [-][HH:]MM:SS[.m...] or [-]S+[.m...], both with optional s/ms/us unit
+duration_syntax = re.compile(r"-?(?:(?:\d+:)?[0-5]?\d:[0-5]?\d|\s*[-+]?\d+)(?:\.\d*)?(?:s|ms|us)?")
+
+# HTTP status codes that mean a stream doesn't exist
+# Everything else (e.g. 5xx) might be temporary and gets retried
+gone_status = (404, 410)
+
+# Result of ffmpeg_probe (kept for server jobs)
+ffmpeg_info = None
+
+# Filename rules for valid_name()
+name_invalid = set('<>:"/\\|?*')
+name_reserved = {"CON", "PRN", "AUX", "NUL"} | \
+                {"COM" + str(i) for i in range(1, 10)} | \
+                {"LPT" + str(i) for i in range(1, 10)}
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Classes
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -53,6 +125,10 @@ class Options:
     # Keep individual video/audio streams
     keep = False
 
+    # Pipe MP3 audio straight into FFmpeg instead of saving it first
+    # Ignored with keep (or for AAC audio, M4A can't be read from a pipe)
+    stream_merge = False
+
     # How often to loop the video
     # If longer than audio duration -> audio decides length
     repeat = 1000
@@ -60,12 +136,27 @@ class Options:
     # Max. coub duration (FFmpeg syntax)
     dur = None
 
-    # Pause between downloads (in sec)
+    # Min. pause between API requests (in sec), overrides api_rate
     sleep_dur = None
 
+    # Max. requests per second to the API/media servers
+    # Throttled requests (HTTP 429/503) lower the rate temporarily
+    api_rate = 5
+    media_rate = 20
+
+    # Max. total download speed (in bytes/sec)
+    limit_rate = None
+
     # Limit how many coubs can be downloaded during one script invocation
     max_coubs = None
 
+    # How many coubs to process in parallel per stage
+    # jobs applies to media downloads
+    # merge_jobs None -> number of CPU cores (max. 4, see check_options)
+    jobs = 1
+    meta_jobs = 1
+    merge_jobs = None
+
     # Default sort order
     sort = "newest"
 
@@ -104,6 +195,41 @@ class Options:
     # Use an archive file to keep track of downloaded coubs
     archive_file = None
 
+    # Root directory of all outputs that may contain the same coubs
+    # Coubs already saved below it get linked instead of downloaded again
+    dedup_root = None
+
+    # Stop parsing a timeline after this many archived coubs in a row
+    # (only makes sense with newest order, older coubs are likely archived too)
+    incremental = None
+
+    # Keep track of the job's progress to resume interrupted runs
+    state_file = None
+    # Only retry coubs of the last job that failed or were unavailable
+    retry_failed = False
+
+    # Write timings/transfer statistics to a file
+    # *.prom -> Prometheus textfile, everything else -> JSON
+    metrics_file = None
+
+    # Profile the run and save the results (pstats format) to a file
+    profile_file = None
+
+    # Accept jobs from stdin ("-") or a local TCP port instead
+    serve = None
+
+    # Server to send API requests to
+    # Meant for mirrors/proxies and local testing (see benchmark/)
+    api_url = "https://coub.com"
+
+    # Cache coub metadata on disk
+    # Timeline pages always get requested fresh, new coubs shift their content
+    cache_dir = None
+    # How long cached responses stay valid (in sec)
+    cache_ttl = 24 * 60 * 60
+    # Max. size of the cache (in MB), least recently used entries get evicted
+    cache_size = 100
+
     # Output name formatting (default: %id%)
     # Supports the following special keywords:
     #   %id%        - coub ID (identifier in the URL)
@@ -114,38 +240,71 @@ class Options:
     #   %tags%      - all tags (separated by tag_sep, see below)
     # All other strings are interpreted literally.
     #
-    # Setting a custom value severely increases skip duration for existing coubs
-    # Usage of an archive file is recommended in such an instance
+    # With a custom value existing coubs can only be skipped without
+    # requesting metadata if they are listed in the output's manifest
+    # (or the format starts with %id% followed by a separator)
     out_format = None
+    # Compiled out_format (see compile_template)
+    # DO NOT TOUCH!
+    out_template = None
 
     # Advanced settings
     page_limit = 99           # used for tags; must be <= 99
+    page_jobs = 4             # timeline pages to request in parallel
+    profile_top = 20          # functions listed in the --profile summary
     coubs_per_page = 25       # allowed: 1-25
-    concat_list = "list.txt"
     tag_sep = "_"
 
 class CoubInputData:
     """Stores coub-related data (e.g. links)"""
 
-    links = []
-    lists = []
-    channels = []
-    tags = []
-    searches = []
-    parsed = []
+    def __init__(self):
+        # Fresh lists per instance, server mode creates one per job
+        self.links = []
+        self.lists = []
+        self.channels = []
+        self.tags = []
+        self.searches = []
+        # Number of links parse_input produced so far
+        self.parsed = 0
+        # Number of links parse_input dropped as duplicates
+        self.duplicates = 0
+        # Whether a timeline couldn't be parsed completely
+        self.incomplete = False
+
+    def inputs(self):
+        """Options that decide which coubs get parsed (see JobState)"""
+
+        # Lists often get regenerated at the same path, so their content counts
+        lists = []
+        for l in self.lists:
+            try:
+                with open(l, "rb") as f:
+                    lists.append([l, hashlib.sha1(f.read()).hexdigest()])
+            except OSError:
+                lists.append([l, None])
+
+        return {'links': self.links, 'lists': lists,
+                'channels': self.channels, 'tags': self.tags,
+                'searches': self.searches, 'sort': opts.sort,
+                'recoubs': opts.recoubs, 'only_recoubs': opts.only_recoubs,
+                'api_url': opts.api_url}
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    # All parsers yield (link, metadata) pairs
+    # Metadata is None unless the source already provides it
 
     def parse_links(self):
         """Parse direct input links from the command line"""
 
-        for link in self.links:
-            if opts.max_coubs and len(self.parsed) >= opts.max_coubs:
-                break
-            self.parsed.append(link)
-
         if self.links:
             msg("Reading command line:")
             msg("  ", len(self.links), " link(s) found", sep="")
 
+        for link in self.links:
+            yield (link, None)
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def parse_lists(self):
@@ -163,38 +322,29 @@ class CoubInputData:
             content = content.replace(" ", "\n")
             content = content.splitlines()
 
-            for link in content:
-                if opts.max_coubs and len(self.parsed) >= opts.max_coubs:
-                    break
-                self.parsed.append(link)
-
             msg("  ", len(content), " link(s) found", sep="")
 
+            for link in content:
+                yield (link, None)
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def parse_timeline(self, url_type, url):
-        """
-        Parse coub links from various Coub source
-
-        Currently supports
-        -) channels
-        -) tags
-        -) coub searches
-        """
+    def timeline_req(self, url_type, url):
+        """Build API request for a Coub timeline"""
 
         if url_type == "channel":
             channel = url.split("/")[-1]
-            req = "https://coub.com/api/v2/timeline/channel/" + channel
+            req = opts.api_url + "/api/v2/timeline/channel/" + channel
             req += "?"
         elif url_type == "tag":
             tag = url.split("/")[-1]
             tag = urlquote(tag)
-            req = "https://coub.com/api/v2/timeline/tag/" + tag
+            req = opts.api_url + "/api/v2/timeline/tag/" + tag
             req += "?"
         elif url_type == "search":
             search = url.split("=")[-1]
             search = urlquote(search)
-            req = "https://coub.com/api/v2/search/coubs?q=" + search
+            req = opts.api_url + "/api/v2/search/coubs?q=" + search
             req += "&"
         else:
             err("Error: Unknown input type in parse_timeline!")
@@ -210,72 +360,1465 @@ class CoubInputData:
         elif opts.sort != "newest":
             req += "&order_by=" + opts.sort
 
-        req_json = urlopen(req).read()
-        req_json = json.loads(req_json)
+        return req
 
-        pages = req_json['total_pages']
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-        msg("Downloading ", url_type, " info (", url, "):", sep="")
+    def parse_page(self, req_json):
+        """Parse coub links from a timeline page"""
 
-        for p in range(1, pages+1):
-            # tag timeline redirects pages >99 to page 1
-            # channel timelines work like intended
-            if url_type == "tag" and p > opts.page_limit:
-                msg("  Max. page limit reached!")
-                return
+        for c in range(opts.coubs_per_page):
+            try:
+                data = req_json['coubs'][c]['recoub_to']
+                c_id = data['permalink']
+                if not opts.recoubs:
+                    continue
+            except (TypeError, KeyError, IndexError):
+                if opts.only_recoubs:
+                    continue
+                try:
+                    data = req_json['coubs'][c]
+                    c_id = data['permalink']
+                except (TypeError, KeyError, IndexError):
+                    continue
 
-            msg("  ", p, " out of ", pages, " pages", sep="")
-            req_json = urlopen(req + "&page=" + str(p)).read()
-            req_json = json.loads(req_json)
+            # Metadata spares the API request for this coub later on
+            yield ("https://coub.com/view/" + c_id, slim_metadata(data))
 
-            for c in range(opts.coubs_per_page):
-                if opts.max_coubs and len(self.parsed) >= opts.max_coubs:
-                    return
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-                try:
-                    c_id = req_json['coubs'][c]['recoub_to']['permalink']
-                    if not opts.recoubs:
-                        continue
-                    self.parsed.append("https://coub.com/view/" + c_id)
-                except (TypeError, KeyError, IndexError):
-                    if opts.only_recoubs:
+    def parse_timelines(self, sources):
+        """
+        Parse coub links from various Coub sources
+
+        Currently supports
+        -) channels
+        -) tags
+        -) coub searches
+
+        The first page of a source tells the total page count, so first
+        pages of all sources are requested together. Remaining pages are
+        fetched in parallel (bounded by opts.page_jobs) and processed in order.
+        """
+
+        if not sources:
+            return
+
+        reqs = [self.timeline_req(url_type, url) for url_type, url in sources]
+
+        # Timelines of an interrupted job continue after the last finished page
+        resume = checkpoint.pages if checkpoint and checkpoint.resumed else {}
+
+        with ThreadPoolExecutor(max_workers=opts.page_jobs) as pool:
+            first_pages = prefetch(pool, api_page,
+                                   [r for s, r in zip(sources, reqs) if s not in resume],
+                                   opts.page_jobs)
+            for source, req in zip(sources, reqs):
+                url_type, url = source
+                if source in resume:
+                    first = None
+                    done, pages = resume[source]
+                else:
+                    first = next(first_pages)
+                    if isinstance(first, Exception):
+                        self.timeline_error(url_type, url, first)
                         continue
-                    try:
-                        c_id = req_json['coubs'][c]['permalink']
-                        self.parsed.append("https://coub.com/view/" + c_id)
-                    except (TypeError, KeyError, IndexError):
+                    done, pages = 0, first['total_pages']
+                # tag timeline redirects pages >99 to page 1
+                # channel timelines work like intended
+                last = pages
+                if url_type == "tag":
+                    last = min(pages, opts.page_limit)
+
+                msg("Downloading ", url_type, " info (", url, "):", sep="")
+                if done:
+                    msg("  Resuming after page ", done, sep="")
+
+                rest = [req + "&page=" + str(p) for p in range(max(done + 1, 2), last+1)]
+                fetched = prefetch(pool, api_page, rest, opts.page_jobs)
+                rest = fetched
+                if first is not None:
+                    rest = chain([first], rest)
+
+                # Consecutive archived coubs (see opts.incremental)
+                archived = 0
+                for p, req_json in enumerate(rest, done + 1):
+                    if isinstance(req_json, Exception):
+                        self.timeline_error(url_type, url, req_json)
+                        break
+                    msg("  ", p, " out of ", pages, " pages", sep="")
+                    for link, data in self.parse_page(req_json):
+                        if opts.incremental:
+                            archived = archived + 1 if read_archive(coub_id(link)) else 0
+                        yield (link, data)
+                        if opts.incremental and archived >= opts.incremental:
+                            break
+                    else:
+                        if checkpoint:
+                            checkpoint.page(source, p, pages)
                         continue
+                    msg("  ", archived, " archived coubs in a row, skipping older ones", sep="")
+                    break
+                # Cancels pages still in flight
+                fetched.close()
+
+                if last < pages:
+                    msg("  Max. page limit reached!")
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def timeline_error(self, url_type, url, error):
+        """Report a timeline page that couldn't be requested"""
 
+        err("Error: Couldn't fetch ", url_type, " info (", url, "): ", error, sep="")
+        err("  Skipping the rest of this ", url_type, sep="")
+        self.incomplete = True
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def parse_input(self):
-        """Parse coub links from all available sources"""
+        """
+        Parse coub links from all available sources
+
+        Works as a generator, so downloads can start as soon as the
+        first links are known (instead of after crawling everything).
+        """
+
+        parsers = [self.parse_links(),
+                   self.parse_lists(),
+                   self.parse_timelines([("channel", c) for c in self.channels] +
+                                        [("tag", t) for t in self.tags] +
+                                        [("search", s) for s in self.searches])]
+
+        # A resumed job starts with the coubs it still has to process
+        # Everything else got parsed before, unless parsing got interrupted
+        known = {}
+        if checkpoint and checkpoint.resumed:
+            known = set(checkpoint.entries)
+            counts = checkpoint.summary()
+            msg("Resuming job (", ", ".join(str(n) + " " + state
+                                            for state, n in counts.items()), ")", sep="")
+            if checkpoint.parse_done or checkpoint.retry:
+                parsers = []
+            parsers.insert(0, checkpoint.todo())
+
+        # The same coub can show up in several sources, as original and
+        # recoub or with different link variants (http/https, query, ...)
+        seen = set()
+        try:
+            for link, data in chain(*parsers):
+                c_id = coub_id(link)
+                if not c_id:
+                    continue
+                if c_id in seen:
+                    if c_id not in known:
+                        self.duplicates += 1
+                    continue
+                if c_id in known and not checkpoint.wanted(c_id):
+                    seen.add(c_id)
+                    continue
+
+                if opts.max_coubs and self.parsed >= opts.max_coubs:
+                    msg("\nDownload limit (", opts.max_coubs, ") reached!", sep="")
+                    break
+                seen.add(c_id)
+                link = "https://coub.com/view/" + c_id
+                if checkpoint and c_id not in checkpoint.entries:
+                    checkpoint.add(c_id, link, data)
+                self.parsed += 1
+                yield (link, data)
+            else:
+                # Failed timelines have to be parsed again on resume
+                if checkpoint and not checkpoint.parse_done and not self.incomplete:
+                    checkpoint.done_parsing()
+        finally:
+            # Stops pending page requests
+            for p in parsers:
+                p.close()
+
+        msg("\nParsed ", self.parsed, " coub(s), ", self.duplicates,
+            " duplicate(s) removed", sep="")
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-        self.parse_links()
-        self.parse_lists()
-        for c in self.channels:
-            self.parse_timeline("channel", c)
-        for t in self.tags:
-            self.parse_timeline("tag", t)
-        for s in self.searches:
-            self.parse_timeline("search", s)
+    def write_list(self):
+        """Write parsed coub links to opts.out_file"""
+
+        with open(opts.out_file, "w") as f:
+            for link, _ in self.parse_input():
+                print(link, file=f)
 
         if not self.parsed:
             err("Error: No coub links specified!")
             clean()
             sys.exit(err_stat['opt'])
 
-        if opts.max_coubs and len(self.parsed) >= opts.max_coubs:
-            msg("\nDownload limit (", opts.max_coubs, ") reached!", sep="")
+        msg("\nParsed coubs written to '", opts.out_file, "'!", sep="")
+
+class RunStats:
+    """Stores download statistics (safe to update from parallel jobs)"""
+
+    def __init__(self):
+        self.done = 0
+        self.skipped = 0
+        self.unavailable = 0
+        # Failed downloads/merges
+        self.failed = 0
+        # Coubs linked from elsewhere (--dedup-root) and their total size
+        self.linked = 0
+        self.saved = 0
+        # IDs already picked up by a job during this run
+        self.claimed = set()
+        # Output names of coubs in progress -> coub ID
+        # Files only appear after merging, until then exists() can't see them
+        self.names = {}
+        self.lock = threading.Lock()
+
+    def add(self, done=0, skipped=0, unavailable=0, failed=0, linked=0, saved=0):
+        """Update counters"""
+        with self.lock:
+            self.done += done
+            self.skipped += skipped
+            self.unavailable += unavailable
+            self.failed += failed
+            self.linked += linked
+            self.saved += saved
+
+    def claim(self, c_id):
+        """Reserve coub ID for the calling job, fails if already taken"""
+        with self.lock:
+            if c_id in self.claimed:
+                return False
+            self.claimed.add(c_id)
+            return True
 
-        if opts.out_file:
-            with open(opts.out_file, "w") as f:
-                for link in self.parsed:
-                    print(link, file=f)
-            msg("\nParsed coubs written to '", opts.out_file, "'!", sep="")
-            clean()
-            sys.exit(0)
+    def reserve(self, name, c_id):
+        """Reserve output name for a coub, fails if another coub took it"""
+        key = os.path.normcase(os.path.abspath(name))
+        with self.lock:
+            return self.names.setdefault(key, c_id) == c_id
+
+class Metrics:
+    """
+    Collects timings, transferred bytes and retries (--metrics)
+
+    Threads bind the coub they are working on, so deeper layers
+    (e.g. HttpSession) can report without knowing about jobs.
+    Work outside of a coub (timelines, archive loading) only shows up
+    in the totals.
+    """
+
+    # Timed stages and plain counters of a record
+    stages = ("api", "video", "audio", "merge", "archive")
+    counters = ("bytes", "api_bytes", "retries", "throttled", "saved")
+
+    def __init__(self):
+        self.started = time.time()
+        self.totals = self.record()
+        # c_id -> record, in order of processing
+        self.coubs = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def record(self):
+        """Empty record"""
+        return dict.fromkeys(self.stages + self.counters, 0)
+
+    def bind(self, c_id):
+        """Attribute work of the calling thread to a coub"""
+        with self.lock:
+            if c_id not in self.coubs:
+                self.coubs[c_id] = self.record()
+            self.local.record = self.coubs[c_id]
+
+    def add(self, key, value):
+        """Add to a stage/counter of the bound coub and the totals"""
+        record = getattr(self.local, "record", None)
+        with self.lock:
+            self.totals[key] += value
+            if record is not None:
+                record[key] += value
+
+    @contextmanager
+    def timed(self, stage):
+        """Measure the wall time of a block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def write(self, path, stats=None):
+        """Save metrics as JSON or Prometheus textfile (*.prom)"""
+
+        results = {}
+        if stats:
+            results = {'processed': stats.done,
+                       'skipped': stats.skipped,
+                       'unavailable': stats.unavailable,
+                       'failed': stats.failed,
+                       'linked': stats.linked}
+        duration = time.time() - self.started
+
+        with self.lock:
+            if path.endswith(".prom"):
+                content = self.prometheus(duration, results)
+            else:
+                content = json.dumps({'started': self.started,
+                                      'duration': duration,
+                                      'results': results,
+                                      'totals': self.totals,
+                                      'coubs': self.coubs}, indent=2)
+
+        # Collectors may read the file at any time
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                print(content, file=f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            err("Error: Couldn't write metrics to '", path, "' (", e, ")!", sep="")
+
+    def prometheus(self, duration, results):
+        """Totals in the Prometheus text format (per-coub data is left out)"""
+
+        lines = ["# HELP coub_run_duration_seconds Wall time of the run",
+                 "# TYPE coub_run_duration_seconds gauge",
+                 "coub_run_duration_seconds " + str(duration),
+                 "# HELP coub_stage_seconds Time spent per stage (summed over parallel jobs)",
+                 "# TYPE coub_stage_seconds gauge"]
+        for stage in self.stages:
+            lines.append('coub_stage_seconds{stage="' + stage + '"} ' +
+                         str(self.totals[stage]))
+        lines.extend(["# HELP coub_coubs Coubs per result",
+                      "# TYPE coub_coubs gauge"])
+        for result, n in results.items():
+            lines.append('coub_coubs{result="' + result + '"} ' + str(n))
+        lines.extend(["# HELP coub_coubs_seen Coubs with recorded metrics",
+                      "# TYPE coub_coubs_seen gauge",
+                      "coub_coubs_seen " + str(len(self.coubs))])
+        for counter in self.counters:
+            lines.extend(["# TYPE coub_" + counter + " gauge",
+                          "coub_" + counter + " " + str(self.totals[counter])])
+        return "\n".join(lines)
+
+class Profiler:
+    """
+    Deterministic profiler for the whole run (--profile)
+
+    Before Python 3.12 cProfile only sees the thread it was enabled in,
+    so every thread started during the run gets its own profile. They get
+    merged when writing the results. Newer versions profile all threads
+    from one profile (and allow no second one). Time spent waiting for ffmpeg is tracked
+    separately, as the profile only shows it as time inside subprocess.
+    """
+
+    def __init__(self):
+        self.profiles = []
+        # label -> [calls, wall time]
+        self.waits = {}
+        self.lock = threading.Lock()
+
+    def call(self, func):
+        """Run func with profiling enabled (in all threads)"""
+
+        main_profile = cProfile.Profile()
+        if sys.version_info >= (3, 12):
+            try:
+                return main_profile.runcall(func)
+            finally:
+                with self.lock:
+                    self.profiles.append(main_profile)
+
+        thread_run = threading.Thread.run
+        profiles = self.profiles
+        lock = self.lock
+
+        def profiled_run(thread):
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(thread_run, thread)
+            finally:
+                with lock:
+                    profiles.append(profile)
+
+        threading.Thread.run = profiled_run
+        try:
+            return main_profile.runcall(func)
+        finally:
+            threading.Thread.run = thread_run
+            with lock:
+                profiles.append(main_profile)
+
+    @contextmanager
+    def waited(self, label):
+        """Measure the wall time of a block waiting for a subprocess"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                calls, total = self.waits.get(label, (0, 0))
+                self.waits[label] = (calls + 1, total + elapsed)
+
+    def write(self, path, top):
+        """Save merged profile to path and print a short summary"""
+
+        with self.lock:
+            profiles = list(self.profiles)
+        summary = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=summary)
+        try:
+            stats.dump_stats(path)
+        except OSError as e:
+            err("Error: Couldn't write profile to '", path, "' (", e, ")!", sep="")
+
+        # Functions that take the most time themselves
+        stats.strip_dirs().sort_stats("tottime").print_stats(top)
+        err("\n### Profile ###")
+        for label, (calls, total) in sorted(self.waits.items()):
+            err("Waiting for ffmpeg in ", label, ": ", "{0:.3f}".format(total),
+                "s (", calls, " call(s))", sep="")
+        err(summary.getvalue().rstrip())
+
+class Archive:
+    """
+    In-memory index of an archive file
+
+    The file gets read only once. New IDs are still appended to it
+    (one ID per line), so it stays compatible with older versions.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = set()
+        self.lock = threading.Lock()
+        # Whether a newline is needed before the next ID
+        self.unterminated = False
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                content = f.read()
+            self.ids = set(content.splitlines())
+            self.unterminated = bool(content) and not content.endswith("\n")
+
+    def __contains__(self, c_id):
+        return c_id in self.ids
+
+    def add(self, c_id):
+        """Record coub ID in memory and append it to the archive file"""
+
+        with self.lock:
+            if c_id in self.ids:
+                return
+            self.ids.add(c_id)
+
+            line = c_id + "\n"
+            if self.unterminated:
+                line = "\n" + line
+                self.unterminated = False
+
+            # Other processes might use the same archive
+            with open(self.path, "a") as f:
+                with locked(f):
+                    f.write(line)
+
+class JobState:
+    """
+    Crash-safe checkpoint of a download job (--state)
+
+    The file is a JSON-lines log: a header with a signature of the input
+    options, every parsed coub (with its metadata), finished timeline pages
+    and state changes of coubs. Every line gets flushed right away, so
+    a killed run loses at most the line it was writing.
+
+    A run with the same inputs picks up an unfinished job: known coubs
+    don't have to be parsed again and timelines continue after the last
+    finished page. Once a job finished, the next run starts a new one
+    (unless failed coubs get retried).
+    """
+
+    # Coub states
+    pending = "pending"
+    downloaded = "downloaded"
+    unavailable = "unavailable"
+    failed = "failed"
+
+    def __init__(self, path, inputs, retry=False):
+        self.path = path
+        self.retry = retry
+        self.signature = hashlib.sha1(json.dumps(inputs, sort_keys=True)
+                                      .encode("utf-8")).hexdigest()
+        # c_id -> [link, metadata, state], in order of parsing
+        self.entries = {}
+        # (url_type, url) -> (last finished page, total pages)
+        self.pages = {}
+        self.parse_done = False
+        self.finished = False
+        self.lock = threading.Lock()
+
+        resumed = self.load()
+        if retry and not resumed:
+            raise ValueError("no job with the same input in state file")
+        if not resumed or (self.finished and not retry):
+            self.entries = {}
+            self.pages = {}
+            self.parse_done = False
+            self.start()
+        self.resumed = resumed and (retry or (bool(self.entries) and not self.finished))
+        self.file = open(path, "a", encoding="utf-8")
+
+    def load(self):
+        """Read an existing state file, returns whether it belongs to this job"""
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = iter(f)
+                header = json.loads(next(lines, "{}"))
+                if header.get('inputs') != self.signature:
+                    return False
+                for line in lines:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Last line of a killed run
+                        break
+                    self.replay(event)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def replay(self, event):
+        """Apply a logged event"""
+
+        if 'parsed' in event:
+            c_id = event['parsed']
+            self.entries[c_id] = [event['link'], event.get('data'), self.pending]
+        elif 'id' in event and event['id'] in self.entries:
+            self.entries[event['id']][2] = event['state']
+        elif 'page' in event:
+            self.pages[tuple(event['page'])] = (event['n'], event['total'])
+        elif 'parse_done' in event:
+            self.parse_done = True
+        elif 'finished' in event:
+            self.finished = True
+
+    def start(self):
+        """Start a new job (replaces the old file)"""
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            print(json.dumps({'inputs': self.signature, 'started': time.time()}), file=f)
+        os.replace(tmp_path, self.path)
+
+    def log(self, event):
+        """Append event to the state file"""
+        with self.lock:
+            self.file.write(json.dumps(event) + "\n")
+            self.file.flush()
+
+    def wanted(self, c_id):
+        """Whether a known coub still needs to be processed"""
+        state = self.entries[c_id][2]
+        if self.retry:
+            return state in (self.failed, self.unavailable)
+        return state == self.pending
+
+    def todo(self):
+        """Known coubs that still need to be processed, as (link, metadata)"""
+        if not self.resumed:
+            return
+        for c_id, (link, data, _) in list(self.entries.items()):
+            if self.wanted(c_id):
+                yield (link, data)
+
+    def add(self, c_id, link, data):
+        """Record a newly parsed coub"""
+        self.entries[c_id] = [link, data, self.pending]
+        self.log({'parsed': c_id, 'link': link, 'data': data})
+
+    def update(self, c_id, state):
+        """Record the state of a coub"""
+        if c_id in self.entries:
+            self.entries[c_id][2] = state
+        self.log({'id': c_id, 'state': state})
+
+    def page(self, source, n, total):
+        """Record a completely parsed timeline page"""
+        self.log({'page': list(source), 'n': n, 'total': total})
+
+    def done_parsing(self):
+        """Record that all inputs were parsed"""
+        self.parse_done = True
+        self.log({'parse_done': True})
+
+    def finish(self):
+        """Record the end of the job"""
+        self.log({'finished': True})
+        self.file.close()
+
+    def summary(self):
+        """Count coubs per state"""
+        counts = {}
+        for _, _, state in self.entries.values():
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+class MetaCache:
+    """
+    Persistent cache for API responses
+
+    Every response is stored as a JSON file named after the hash of its
+    request URL. The modification time of a file marks its last use, so
+    the least recently used entries get evicted once the size limit is hit.
+    """
+
+    def __init__(self, path, ttl, max_size):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(e.stat().st_size for e in os.scandir(path)
+                        if e.name.endswith(".json"))
+
+    def entry(self, url):
+        """Path of the cache entry for url"""
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, url):
+        """Return cached response or None"""
+
+        entry = self.entry(url)
+        try:
+            with open(entry, "r", encoding="utf-8") as f:
+                content = json.load(f)
+            if content['url'] != url or time.time() - content['time'] > self.ttl:
+                raise KeyError
+            # Mark as recently used
+            os.utime(entry)
+        except (OSError, ValueError, KeyError, TypeError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return content['data']
+
+    def put(self, url, data):
+        """Store response in the cache"""
+
+        entry = self.entry(url)
+        tmp = entry + "." + str(threading.get_ident()) + ".tmp"
+        try:
+            old_size = os.path.getsize(entry)
+        except OSError:
+            old_size = 0
+
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({'url': url, 'time': time.time(), 'data': data}, f)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, entry)
+        except OSError:
+            # A broken cache shouldn't stop any downloads
+            return
+
+        with self.lock:
+            self.size += size - old_size
+            if self.size > self.max_size * 1024**2:
+                self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is 10% below its limit"""
+
+        entries = [e for e in os.scandir(self.path) if e.name.endswith(".json")]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+
+        limit = self.max_size * 1024**2 * 0.9
+        self.size = sum(e.stat().st_size for e in entries)
+        for e in entries:
+            if self.size <= limit:
+                break
+            try:
+                size = e.stat().st_size
+                os.remove(e.path)
+                self.size -= size
+            except OSError:
+                continue
+
+class OutputIndex:
+    """
+    Index of existing output files
+
+    Output directories get listed once, instead of probing the disk for
+    every candidate name of every coub. With custom output formatting a
+    manifest file remembers the name each coub was saved under, so
+    existing coubs can be skipped before requesting their metadata.
+    """
+
+    manifest_name = ".coub_manifest"
+    # Merge leftovers that don't count as finished output
+    partial = ("_raw.mp4", "_.mp4", ".part")
+
+    def __init__(self, template):
+        # Directory -> names of files inside
+        self.dirs = {}
+        # Directory -> whether it exists
+        self.known_dirs = {}
+        # Directory -> {coub ID: names}, see guess()
+        self.id_prefixes = {}
+        self.lock = threading.Lock()
+
+        # Leading part of the template that contains no keywords
+        self.head, self.tail = os.path.split(template or "")
+        if "%" in self.head:
+            self.head = None
+        # Literal text that follows an ID at the start of the filename
+        self.id_sep = None
+        if self.tail.startswith("%id%"):
+            self.id_sep = self.tail[len("%id%"):].split("%")[0]
+
+        # Coub ID -> output name (relative to the manifest)
+        self.manifest = {}
+        self.manifest_dir = self.head or "."
+        self.manifest_path = os.path.join(self.manifest_dir, self.manifest_name)
+        if template and os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    c_id, _, name = line.rstrip("\n").partition("\t")
+                    if name:
+                        self.manifest[c_id] = name
+
+    def listing(self, directory):
+        """Names of all files in directory (listed only once)"""
+
+        key = os.path.normcase(os.path.abspath(directory or "."))
+        with self.lock:
+            if key not in self.dirs:
+                try:
+                    names = {os.path.normcase(e.name) for e in os.scandir(key)}
+                except OSError:
+                    names = set()
+                self.dirs[key] = names
+            return self.dirs[key]
+
+    def is_dir(self, directory):
+        """Check if directory exists (checked only once)"""
+
+        key = os.path.normcase(os.path.abspath(directory))
+        with self.lock:
+            if key not in self.known_dirs:
+                self.known_dirs[key] = os.path.isdir(key)
+            return self.known_dirs[key]
+
+    def exists(self, path):
+        """Check if file exists"""
+        directory, name = os.path.split(path)
+        return os.path.normcase(name) in self.listing(directory)
+
+    def add(self, path):
+        """Record a newly created file"""
+        directory, name = os.path.split(path)
+        names = self.listing(directory)
+        with self.lock:
+            names.add(os.path.normcase(name))
+
+    def remember(self, c_id, name):
+        """Record the output name of a coub in the manifest"""
+
+        rel_name = os.path.relpath(name, self.manifest_dir)
+        with self.lock:
+            if self.manifest.get(c_id) == rel_name:
+                return
+            self.manifest[c_id] = rel_name
+            # The manifest only speeds up later runs, don't fail over it
+            try:
+                with open(self.manifest_path, "a", encoding="utf-8") as f:
+                    with locked(f):
+                        print(c_id, rel_name, sep="\t", file=f)
+            except OSError:
+                pass
+
+    def guess(self, c_id):
+        """Output name of a coub before knowing its metadata (or None)"""
+
+        name = self.manifest.get(c_id)
+        if name:
+            return os.path.join(self.manifest_dir, name)
+
+        # Without a manifest entry the name can only be derived for
+        # templates that start with the ID (e.g. %id%_%title%)
+        if self.head is None or self.id_sep is None:
+            return None
+        if not self.id_sep:
+            return os.path.join(self.head, c_id) if self.tail == "%id%" else None
+
+        directory = self.head or "."
+        with self.lock:
+            prefixes = self.id_prefixes.get(directory)
+        if prefixes is None:
+            prefixes = {}
+            try:
+                for e in os.scandir(directory):
+                    base, ext = os.path.splitext(e.name)
+                    if ext not in (".mp4", ".mp3", ".m4a") or \
+                       e.name.endswith(self.partial):
+                        continue
+                    prefixes.setdefault(e.name.split(self.id_sep)[0], []).append(base)
+            except OSError:
+                pass
+            with self.lock:
+                self.id_prefixes[directory] = prefixes
+
+        for base in prefixes.get(c_id, []):
+            return os.path.join(self.head, base)
+        return None
+
+class DedupIndex:
+    """
+    Index of finished coubs anywhere below a root directory (--dedup-root)
+
+    Maps coub ID and output variant (qualities, loops, etc.) to a file
+    relative to the root, so a coub needed in several output directories
+    only gets downloaded once. Entries are appended as JSON lines and
+    checked against the file size before use, files might have been
+    deleted or replaced since.
+    """
+
+    index_name = ".coub_dedup"
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, self.index_name)
+        # key -> [relative path, size, name metadata]
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry['key']] = [entry['path'], entry['size'],
+                                                      entry.get('meta')]
+                    except (ValueError, KeyError, TypeError):
+                        # Last line of a killed run
+                        continue
+
+    @staticmethod
+    def key(c_id):
+        """Index key of a coub downloaded with the current options"""
+        variant = (opts.v_quality, opts.a_quality, opts.aac, opts.share,
+                   opts.v_only, opts.a_only, opts.repeat, opts.dur)
+        return c_id + ":" + "/".join(str(v) for v in variant)
+
+    def find(self, c_id):
+        """Existing file of a coub as (path, size, name metadata) or None"""
+
+        with self.lock:
+            entry = self.entries.get(self.key(c_id))
+        if not entry:
+            return None
+
+        path = os.path.join(self.root, entry[0])
+        try:
+            if os.path.getsize(path) != entry[1]:
+                return None
+        except OSError:
+            return None
+        return (path, entry[1], entry[2])
+
+    def add(self, c_id, path, meta):
+        """Record a finished coub"""
+
+        try:
+            rel_path = os.path.relpath(os.path.abspath(path), self.root)
+            size = os.path.getsize(path)
+        except (OSError, ValueError):
+            return
+        # Outputs outside of the root don't belong into the index
+        if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+            return
+
+        key = self.key(c_id)
+        entry = [rel_path, size, meta]
+        with self.lock:
+            if self.entries.get(key) == entry:
+                return
+            self.entries[key] = entry
+            # The index only saves downloads, don't fail over it
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    with locked(f):
+                        print(json.dumps({'key': key, 'path': rel_path,
+                                          'size': size, 'meta': meta}), file=f)
+            except OSError:
+                pass
+
+class CoubJob:
+    """Stores the state of a single coub while it moves through the pipeline"""
+
+    def __init__(self, link, count, data=None):
+        self.link = link
+        self.c_id = link.split("/")[-1]
+        self.count = count
+        # Metadata provided by the input source or the API (if any)
+        self.data = data
+        self.name = None
+        # Name of intermediate files (streams, partial downloads, merge output)
+        self.temp = None
+        self.v_link = None
+        self.a_link = None
+        self.a_ext = None
+        # Audio gets piped into FFmpeg instead of downloaded (--stream-merge)
+        self.pipe_audio = False
+
+class Pipeline:
+    """
+    Process coubs in stages connected by bounded queues
+
+    Every stage gets its own pool of worker threads. A stage function
+    returns True to pass the job on to the next stage. Queues only hold
+    as many jobs as the next stage has workers, so a slow stage throttles
+    the ones in front of it instead of piling up metadata or temp files.
+    """
+
+    def __init__(self, stages, stats):
+        self.stages = stages
+        self.stats = stats
+        self.queues = [queue.Queue(maxsize=n) for _, n in stages]
+        self.stop = threading.Event()
+        self.errors = []
+        self.lock = threading.Lock()
+        # Workers still running per stage
+        self.running = [n for _, n in stages]
+
+    def work(self, index):
+        """Worker loop of a single stage"""
+
+        func, _ = self.stages[index]
+        q_in = self.queues[index]
+        while True:
+            job = q_in.get()
+            if job is None:
+                break
+            if self.stop.is_set():
+                continue
+            try:
+                if func(job, self.stats) and index + 1 < len(self.stages):
+                    self.queues[index + 1].put(job)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+
+        # Last worker of a stage shuts down the next one
+        with self.lock:
+            self.running[index] -= 1
+            last = not self.running[index]
+        if last and index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1][1]):
+                self.queues[index + 1].put(None)
+
+    def feed(self, jobs):
+        """Push jobs into the first stage"""
+
+        try:
+            for job in jobs:
+                if self.stop.is_set():
+                    break
+                self.queues[0].put(job)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+        finally:
+            for _ in range(self.stages[0][1]):
+                self.queues[0].put(None)
+
+    def run(self, jobs):
+        """Process all jobs, returns after the last stage finished"""
+
+        threads = [threading.Thread(target=self.feed, args=(jobs,), daemon=True)]
+        for index, (_, n) in enumerate(self.stages):
+            for _ in range(n):
+                threads.append(threading.Thread(target=self.work, args=(index,),
+                                                daemon=True))
+        for t in threads:
+            t.start()
+
+        try:
+            # Join with timeout to stay responsive to Ctrl+C
+            for t in threads:
+                while t.is_alive():
+                    t.join(0.5)
+        except KeyboardInterrupt:
+            # Drop queued jobs, running ones end with the process
+            self.stop.set()
+            raise
+
+        # Unexpected errors shouldn't go unnoticed
+        if self.errors:
+            raise self.errors[0]
+
+class RateLimiter:
+    """
+    Adaptive token bucket for requests to a group of hosts
+
+    Starts out at rate (requests/sec) and never exceeds max_rate.
+    A throttled request (HTTP 429/503) halves the rate and pauses all
+    requests for the time the server asked for. Every other response
+    raises the rate again by a small step, until max_rate is reached.
+    """
+
+    min_rate = 0.05
+    # Share of max_rate regained per successful request
+    step = 0.05
+
+    def __init__(self, rate, max_rate, burst=1):
+        self.max_rate = max_rate
+        self.rate = min(rate, max_rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until the next request may be sent"""
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self, delay=None):
+        """Back off after the server throttled a request"""
+
+        with self.lock:
+            self.throttled += 1
+            # Long --sleep pauses may already be below min_rate
+            self.rate = min(max(self.rate / 2, self.min_rate), self.max_rate)
+            self.tokens = 0
+            if delay is None:
+                delay = 1 / self.rate
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def relax(self):
+        """Recover speed after a request went through"""
+
+        with self.lock:
+            self.rate = min(self.rate + self.max_rate * self.step, self.max_rate)
+
+class BandwidthLimiter:
+    """
+    Token bucket (in bytes) shared by all media downloads
+
+    Streams ask for permission after every chunk, so the cap holds
+    across the video/audio fetches of all parallel jobs and the data
+    flows smoothly instead of pausing between whole files.
+    """
+
+    def __init__(self, rate):
+        # Bytes per second
+        self.rate = rate
+        # Allow bursts of up to 1/10 sec
+        self.burst = rate / 10
+        # Read at most this much data before asking for permission again
+        self.chunk_size = max(int(self.burst), 1024)
+        self.tokens = 0
+        self.updated = time.monotonic()
+        # Stats
+        self.total = 0
+        self.started = None
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Account for amount bytes, blocks while over budget"""
+
+        with self.lock:
+            now = time.monotonic()
+            if self.started is None:
+                self.started = now
+            self.total += amount
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going into debt makes later callers wait as well
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def throughput(self):
+        """Average bytes per second since the first chunk"""
+
+        if self.started is None:
+            return 0
+        return self.total / max(time.monotonic() - self.started, 1e-6)
+
+class ResumingHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection that resumes a previous TLS session of the same host"""
+
+    tls_session = None
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        # Behind a proxy self.host is the proxy, not the server
+        self.sock = self._context.wrap_socket(self.sock,
+                                              server_hostname=self._tunnel_host or self.host,
+                                              session=self.tls_session)
+
+class HttpSession:
+    """
+    Shared transport for all network I/O
+
+    Keeps a pool of keep-alive connections per host, so API calls and
+    CDN fetches don't pay a new TCP+TLS handshake each time. New
+    connections resume the last TLS session of their host.
+    The (randomized) user agent is chosen once per session.
+    Proxies are taken from HTTP(S)_PROXY/NO_PROXY (or the system
+    settings), like urllib does.
+    """
+
+    # Idle connections to keep per host
+    max_idle = 8
+    # Socket timeout (in sec)
+    timeout = 30
+    max_redirects = 5
+    # How often to retry a request the server throttled (HTTP 429/503)
+    max_throttled = 8
+    chunk_size = 64 * 1024
+    # Requests to this host count against the API rate limit,
+    # everything else (i.e. the media CDN) against the media one
+    api_host = "coub.com"
+
+    def __init__(self):
+        self.agent = random_agent()
+        # Honours the PYTHONHTTPSVERIFY handling at the top of the script
+        self.context = ssl._create_default_https_context()
+        # (scheme, host) -> idle connections
+        self.pools = {}
+        # host -> last TLS session
+        self.tls_sessions = {}
+        # scheme -> proxy URL, host -> whether it bypasses the proxy
+        self.proxies = urllib.request.getproxies()
+        self.bypass = {}
+        self.lock = threading.Lock()
+        # RateLimiter instances (None -> unlimited)
+        self.api_limiter = None
+        self.media_limiter = None
+        # BandwidthLimiter for media downloads (None -> unlimited)
+        self.bandwidth = None
+
+    def proxy(self, scheme, host):
+        """Proxy URL to reach host through (None -> connect directly)"""
+
+        url = self.proxies.get(scheme)
+        if not url:
+            return None
+        if host not in self.bypass:
+            self.bypass[host] = bool(urllib.request.proxy_bypass(host))
+        return None if self.bypass[host] else url
+
+    def connect(self, scheme, host):
+        """Create a new connection to host (through a proxy if configured)"""
+
+        proxy = self.proxy(scheme, host)
+        if not proxy:
+            if scheme == "https":
+                conn = ResumingHTTPSConnection(host, timeout=self.timeout,
+                                               context=self.context)
+            else:
+                conn = http.client.HTTPConnection(host, timeout=self.timeout)
+            conn.forward_headers = None
+            return conn
+
+        parts = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+        proxy_host = parts.netloc.rpartition("@")[2]
+        auth = {}
+        if parts.username:
+            credentials = unquote(parts.username) + ":" + unquote(parts.password or "")
+            auth['Proxy-Authorization'] = "Basic " + \
+                base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+
+        # HTTPS gets tunneled, plain HTTP requests are sent to the proxy
+        if scheme == "https":
+            conn = ResumingHTTPSConnection(proxy_host, timeout=self.timeout,
+                                           context=self.context)
+            conn.set_tunnel(host, headers=auth)
+            conn.forward_headers = None
+        else:
+            conn = http.client.HTTPConnection(proxy_host, timeout=self.timeout)
+            conn.forward_headers = auth
+        return conn
+
+    def acquire(self, scheme, host, fresh=False):
+        """Get an idle connection to host or create a new one"""
+
+        with self.lock:
+            pool = self.pools.get((scheme, host))
+            conn = pool.pop() if pool and not fresh else None
+            tls_session = self.tls_sessions.get(host)
+
+        if not conn:
+            conn = self.connect(scheme, host)
+        # Pooled connections may have to reconnect as well
+        if scheme == "https":
+            conn.tls_session = tls_session
+        return conn
+
+    def release(self, resp):
+        """Return the connection of a response to its pool"""
+
+        conn = resp.conn
+        # Connections with unread data can't be reused
+        if not resp.isclosed():
+            conn.close()
+            return
+
+        with self.lock:
+            if isinstance(conn.sock, ssl.SSLSocket) and conn.sock.session:
+                self.tls_sessions[resp.pool_key[1]] = conn.sock.session
+            pool = self.pools.setdefault(resp.pool_key, [])
+            if len(pool) < self.max_idle:
+                pool.append(conn)
+            else:
+                conn.close()
+
+    def discard(self, key):
+        """Close all idle connections of a (scheme, host) pool"""
+
+        with self.lock:
+            pool = self.pools.pop(key, [])
+        for conn in pool:
+            conn.close()
+
+    def limiter(self, host):
+        """Rate limiter responsible for host"""
+        if host == self.api_host:
+            return self.api_limiter
+        return self.media_limiter
+
+    def open(self, url, headers=None):
+        """Send GET request and return the response (call release() after reading)"""
+
+        redirects = 0
+        throttled = 0
+        while True:
+            parts = urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+
+            req_headers = {'User-Agent': self.agent}
+            if headers:
+                req_headers.update(headers)
+
+            limiter = self.limiter(parts.netloc)
+            if limiter:
+                limiter.acquire()
+
+            # Idle connections may have been closed by the server in the meantime
+            for attempt in range(2):
+                conn = self.acquire(parts.scheme, parts.netloc, fresh=attempt > 0)
+                reused = conn.sock is not None
+                target = path
+                if conn.forward_headers is not None:
+                    target = parts.scheme + "://" + parts.netloc + path
+                    req_headers.update(conn.forward_headers)
+                try:
+                    conn.request("GET", target, headers=req_headers)
+                    resp = conn.getresponse()
+                except (http.client.HTTPException, OSError):
+                    conn.close()
+                    if reused and not attempt:
+                        # The rest of the pool idled just as long, retry with a new connection
+                        self.discard((parts.scheme, parts.netloc))
+                        continue
+                    raise
+                break
+
+            resp.conn = conn
+            resp.pool_key = (parts.scheme, parts.netloc)
+
+            # Server asks us to slow down
+            if resp.status in (429, 503) and limiter and throttled < self.max_throttled:
+                resp.read()
+                self.release(resp)
+                limiter.throttle(retry_after(resp.getheader("Retry-After")))
+                throttled += 1
+                count("throttled")
+                continue
+            if limiter:
+                limiter.relax()
+
+            if resp.status in (301, 302, 303, 307, 308) and resp.getheader("Location"):
+                resp.read()
+                self.release(resp)
+                if redirects >= self.max_redirects:
+                    raise urllib.error.HTTPError(url, resp.status, "Too many redirects",
+                                                 resp.headers, None)
+                redirects += 1
+                url = urljoin(url, resp.getheader("Location"))
+                continue
+
+            if resp.status >= 400:
+                body = resp.read()
+                self.release(resp)
+                raise urllib.error.HTTPError(url, resp.status, resp.reason,
+                                             resp.headers, io.BytesIO(body))
+            return resp
+
+    def read(self, url):
+        """Return the (decompressed) body of url"""
+
+        resp = self.open(url, {'Accept-Encoding': "gzip"})
+        try:
+            body = resp.read()
+        finally:
+            self.release(resp)
+
+        count("api_bytes", len(body))
+        if resp.getheader("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def get_json(self, url):
+        """Request and decode a JSON document"""
+        return json.loads(self.read(url))
+
+    def copy(self, resp, f):
+        """Write the body of resp to a file object, returns the byte count"""
+
+        chunk_size = self.chunk_size
+        if self.bandwidth:
+            chunk_size = min(chunk_size, self.bandwidth.chunk_size)
+
+        received = 0
+        try:
+            while True:
+                chunk = resp.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                received += len(chunk)
+                if self.bandwidth:
+                    self.bandwidth.consume(len(chunk))
+        finally:
+            count("bytes", received)
+        return received
+
+    def retrieve(self, url, filename):
+        """
+        Download url into filename
+
+        Data goes into filename.part first, which gets resumed with a Range
+        request if it already exists (e.g. after a failed attempt or crash).
+        filename only appears once the download is complete.
+        filename.part.src remembers URL and ETag/Last-Modified of the data,
+        so only the same (unchanged) file gets resumed.
+        """
+
+        part = filename + ".part"
+        src = part + ".src"
+        try:
+            offset = os.path.getsize(part)
+        except OSError:
+            offset = 0
+
+        headers = None
+        if offset:
+            try:
+                with open(src, "r", encoding="utf-8") as f:
+                    source = json.load(f)
+            except (OSError, ValueError):
+                source = {}
+            # Leftover of another stream (e.g. a different quality), start over
+            if source.get("url") != url:
+                os.remove(part)
+                offset = 0
+            else:
+                headers = {'Range': "bytes=" + str(offset) + "-"}
+                # Server sends the whole file instead if it changed
+                if source.get("validator"):
+                    headers['If-Range'] = source['validator']
+
+        try:
+            resp = self.open(url, headers)
+        except urllib.error.HTTPError as e:
+            # Leftover doesn't fit the file (anymore), start over
+            if e.code != 416:
+                raise
+            os.remove(part)
+            return self.retrieve(url, filename)
+
+        try:
+            # Content-Range: bytes <start>-<end>/<total>
+            c_range = resp.getheader("Content-Range", "")
+            if resp.status == 206:
+                if not c_range.startswith("bytes " + str(offset) + "-"):
+                    os.remove(part)
+                    raise http.client.HTTPException("Unexpected range: " + c_range)
+                mode = "ab"
+                total = c_range.split("/")[-1]
+            else:
+                # Server ignored the range request (or the file changed)
+                mode = "wb"
+                total = resp.getheader("Content-Length")
+                # If-Range only accepts strong ETags
+                validator = resp.getheader("ETag")
+                if not validator or validator.startswith("W/"):
+                    validator = resp.getheader("Last-Modified")
+                with open(src, "w", encoding="utf-8") as f:
+                    json.dump({'url': url, 'validator': validator}, f)
+
+            with open(part, mode) as f:
+                self.copy(resp, f)
+        finally:
+            self.release(resp)
+
+        if total and total.isdigit() and os.path.getsize(part) != int(total):
+            raise http.client.IncompleteRead(b"", int(total) - os.path.getsize(part))
+        os.replace(part, filename)
+        os.remove(src)
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Serves jobs of a single client connection (see serve)"""
+
+    def handle(self):
+        send = event_sender(lambda line: self.wfile.write(line.encode("utf-8")))
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            # Jobs change global state (and the working directory)
+            with self.server.job_lock:
+                serve_job(line.decode("utf-8"), send)
+
+class JobServer(socketserver.ThreadingTCPServer):
+    """Local TCP server for jobs (see serve)"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port):
+        super().__init__(("127.0.0.1", port), JobHandler)
+        self.job_lock = threading.Lock()
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Functions
@@ -283,12 +1826,122 @@ class CoubInputData:
 
 def err(*args, **kwargs):
     """Print to stderr"""
-    print(*args, file=sys.stderr, **kwargs)
+    with print_lock:
+        print(*args, file=sys.stderr, **kwargs)
 
 def msg(*args, **kwargs):
     """Print to stdout based on verbosity level"""
     if opts.verbosity >= 1:
-        print(*args, **kwargs)
+        with print_lock:
+            print(*args, **kwargs)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def timed(stage):
+    """Time a block for --metrics (no-op without it)"""
+    if metrics:
+        return metrics.timed(stage)
+    return nullcontext()
+
+def count(key, value=1):
+    """Add to a --metrics counter (no-op without it)"""
+    if metrics:
+        metrics.add(key, value)
+
+def mark(c_id, state):
+    """Record the state of a coub (--state and server progress events)"""
+    if checkpoint:
+        checkpoint.update(c_id, state)
+    if events:
+        events(c_id, state)
+
+def reuse(cls, *args):
+    """Instance of cls for args, shared between server jobs"""
+    key = (cls,) + args
+    if key not in shared:
+        shared[key] = cls(*args)
+    return shared[key]
+
+def ffmpeg_wait(label):
+    """Time a block waiting for ffmpeg for --profile (no-op without it)"""
+    if profiler:
+        return profiler.waited(label)
+    return nullcontext()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def prefetch(pool, func, items, window):
+    """
+    Map func over items in a thread pool
+
+    Results get yielded in order, with at most window calls in flight.
+    Closing the generator cancels calls that haven't started yet.
+    """
+
+    items = iter(items)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= window:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for item in items:
+                pending.append(pool.submit(func, item))
+                break
+            yield result
+    finally:
+        for f in pending:
+            f.cancel()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def retry_after(value):
+    """Convert a Retry-After header (seconds or HTTP date) to seconds"""
+
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def parse_size(size):
+    """Convert a size with optional K/M/G suffix (e.g. 500K) to bytes"""
+
+    units = {"k": 1024, "m": 1024**2, "g": 1024**3}
+    size = size.strip()
+    if size[-1:].lower() in units:
+        return float(size[:-1]) * units[size[-1].lower()]
+    return float(size)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def format_size(size):
+    """Format byte count for humans"""
+
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return "{0:.1f} {1}".format(size, unit)
+        size /= 1024
+    return "{0:.1f} GB".format(size)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def random_agent():
+    """Randomize user agent a bit"""
+    n1 = random.randint(3000,4600)
+    n2 = random.randint(500,600)
+    n3 = random.randint(80,100)
+    return 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/{1}.43 (KHTML, like Gecko) Chrome/{2}.0.{0}.82 Safari/537.36 OPR/79.0.4143.56'.format(n1, n2, n3)
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -314,12 +1967,23 @@ Common options:
   -s, --short            disable video looping
   -p, --path PATH        set output destination (default: '{opts.path}')
   -k, --keep             keep the individual video/audio parts
+  --stream-merge         pipe MP3 audio straight into FFmpeg while merging
+                         (the video is still saved first, looping needs it)
   -r, --repeat N         repeat video N times (default: until audio ends)
   -d, --duration TIME    specify max. coub duration (FFmpeg syntax)
 
 Download options:
-  --sleep TIME           pause the script for TIME seconds before each download
+  --sleep TIME           pause TIME seconds between API requests
+                         (max. one request per TIME seconds, overrides --api-rate)
+  --api-rate N           max. API requests per second (default: {opts.api_rate})
+  --media-rate N         max. media requests per second (default: {opts.media_rate})
+  --limit-rate RATE      limit total download speed to RATE bytes/sec
+                         (suffixes K, M and G are supported, e.g. 500K)
   --limit-num LIMIT      limit max. number of downloaded coubs
+  -j, --jobs N           download N coubs in parallel (default: {opts.jobs})
+  --meta-jobs N          request metadata of N coubs in parallel (default: {opts.meta_jobs})
+  --merge-jobs N         merge N coubs in parallel
+                         (default: number of CPU cores, max. 4)
   --sort ORDER           specify download order for channels/tags
                          Allowed values:
                            newest (default)      likes_count
@@ -345,6 +2009,26 @@ Misc. options:
   --video-only           only download video streams
   --write-list FILE      write all parsed coub links to FILE
   --use-archive FILE     use FILE to keep track of already downloaded coubs
+  --dedup-root DIR       link coubs that were already downloaded somewhere
+                         below DIR (same quality) instead of downloading them
+  --incremental N        stop parsing a channel/tag/search after N coubs in a
+                         row that are already in the archive (newest order only)
+  --state FILE           save the job's progress to FILE, so an interrupted
+                         run with the same input can resume without parsing
+                         everything again
+  --retry-failed         only retry coubs of the last job (see --state) that
+                         failed or were unavailable
+  --metrics FILE         write timings and transfer statistics to FILE
+                         (JSON, Prometheus textfile if FILE ends with .prom)
+  --profile FILE         profile the run, save the results to FILE (pstats)
+                         and print the slowest functions
+  --serve ADDRESS        keep running and accept download jobs as JSON lines
+                         from stdin ('-') or a TCP port on localhost
+                         (e.g. {{"id": 1, "args": ["-c", "CHANNEL"]}})
+  --cache DIR            cache coub metadata in DIR (timelines aren't cached)
+  --cache-ttl TIME       reuse cached responses for TIME seconds (default: {opts.cache_ttl})
+  --cache-size SIZE      limit the cache to SIZE MB (default: {opts.cache_size})
+  --api-url URL          send API requests to URL (default: {opts.api_url})
 
 Output:
   -o, --output FORMAT    save output with the specified name (default: %id%)
@@ -365,12 +2049,74 @@ Output:
 def check_prereq():
     """check existence of required software"""
 
-    try:
-        subprocess.run(["ffmpeg"], stdout=subprocess.DEVNULL, \
-                                   stderr=subprocess.DEVNULL)
-    except FileNotFoundError:
+    info = ffmpeg_probe()
+    if not info:
         err("Error: FFmpeg not found!")
         sys.exit(err_stat['dep'])
+    if not info['stream_loop']:
+        err("Error: FFmpeg ", info['version'], " is too old (-stream_loop is missing)!", sep="")
+        sys.exit(err_stat['dep'])
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def ffmpeg_probe():
+    """
+    Find FFmpeg and check its capabilities
+
+    Spawning FFmpeg is slow on some systems, so results get cached
+    (in memory and on disk) by path, size and mtime of the binary.
+    Returns None if FFmpeg can't be found.
+    """
+    global ffmpeg_info
+
+    path = shutil.which("ffmpeg")
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    stamp = [path, stat.st_size, stat.st_mtime]
+
+    if ffmpeg_info and ffmpeg_info['stamp'] == stamp:
+        return ffmpeg_info
+
+    cache_file = os.path.join(os.environ.get("LOCALAPPDATA") or
+                              os.environ.get("XDG_CACHE_HOME") or
+                              os.path.join(os.path.expanduser("~"), ".cache"),
+                              "coub_v2", "ffmpeg.json")
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            info = json.load(f)
+        if info['stamp'] == stamp:
+            ffmpeg_info = info
+            return info
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    # The banner (stderr) tells the version, the help text the options
+    try:
+        with ffmpeg_wait("check_prereq"):
+            result = subprocess.run([path, "-h", "long"], stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, universal_newlines=True,
+                                    errors="replace")
+    except OSError:
+        return None
+    version = re.search(r"version (\S+)", result.stderr)
+    info = {'stamp': stamp,
+            'version': version.group(1) if version else "unknown",
+            'stream_loop': "-stream_loop" in result.stdout}
+    ffmpeg_info = info
+
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = cache_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(info, f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+    return info
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -390,10 +2136,26 @@ def parse_cli():
                 "-r", "--repeat",
                 "-d", "--duration",
                 "--sleep",
+                "--api-rate",
+                "--media-rate",
+                "--limit-rate",
                 "--limit-num",
+                "-j", "--jobs",
+                "--meta-jobs",
+                "--merge-jobs",
                 "--sort",
                 "--write-list",
                 "--use-archive",
+                "--dedup-root",
+                "--incremental",
+                "--state",
+                "--metrics",
+                "--profile",
+                "--serve",
+                "--cache",
+                "--cache-ttl",
+                "--cache-size",
+                "--api-url",
                 "-o", "--output"]
 
     pos = 1
@@ -441,6 +2203,8 @@ def parse_cli():
                 opts.path = arg
             elif opt in ("-k", "--keep"):
                 opts.keep = True
+            elif opt in ("--stream-merge",):
+                opts.stream_merge = True
             elif opt in ("-r", "--repeat"):
                 opts.repeat = int(arg)
             elif opt in ("-d", "--duration"):
@@ -448,8 +2212,20 @@ def parse_cli():
             # Download options
             elif opt in ("--sleep",):
                 opts.sleep_dur = float(arg)
+            elif opt in ("--api-rate",):
+                opts.api_rate = float(arg)
+            elif opt in ("--media-rate",):
+                opts.media_rate = float(arg)
+            elif opt in ("--limit-rate",):
+                opts.limit_rate = parse_size(arg)
             elif opt in ("--limit-num",):
                 opts.max_coubs = int(arg)
+            elif opt in ("-j", "--jobs"):
+                opts.jobs = int(arg)
+            elif opt in ("--meta-jobs",):
+                opts.meta_jobs = int(arg)
+            elif opt in ("--merge-jobs",):
+                opts.merge_jobs = int(arg)
             elif opt in ("--sort",):
                 opts.sort = arg
             # Format selection
@@ -485,6 +2261,28 @@ def parse_cli():
                 opts.out_file = os.path.abspath(arg)
             elif opt in ("--use-archive",):
                 opts.archive_file = os.path.abspath(arg)
+            elif opt in ("--dedup-root",):
+                opts.dedup_root = arg
+            elif opt in ("--incremental",):
+                opts.incremental = int(arg)
+            elif opt in ("--state",):
+                opts.state_file = os.path.abspath(arg)
+            elif opt in ("--retry-failed",):
+                opts.retry_failed = True
+            elif opt in ("--metrics",):
+                opts.metrics_file = os.path.abspath(arg)
+            elif opt in ("--profile",):
+                opts.profile_file = os.path.abspath(arg)
+            elif opt in ("--serve",):
+                opts.serve = arg
+            elif opt in ("--cache",):
+                opts.cache_dir = os.path.abspath(arg)
+            elif opt in ("--cache-ttl",):
+                opts.cache_ttl = float(arg)
+            elif opt in ("--cache-size",):
+                opts.cache_size = float(arg)
+            elif opt in ("--api-url",):
+                opts.api_url = arg.rstrip("/")
             # Output
             elif opt in ("-o", "--output"):
                 opts.out_format = arg
@@ -508,24 +2306,65 @@ def parse_cli():
 def check_options():
     """Check validity of command line options"""
 
+    # Remuxing (-c copy) is mostly bound by the disk, not the CPU,
+    # so more parallel merges than that only fight over the disk
+    if opts.merge_jobs is None:
+        opts.merge_jobs = max(1, min(os.cpu_count() or 1, 4))
+
     if opts.repeat <= 0:
         err("-r/--repeat must be greater than 0!")
         sys.exit(err_stat['opt'])
     elif opts.max_coubs and opts.max_coubs <= 0:
         err("--limit-num must be greater than zero!")
         sys.exit(err_stat['opt'])
+    elif min(opts.jobs, opts.meta_jobs, opts.merge_jobs) <= 0:
+        err("-j/--jobs, --meta-jobs and --merge-jobs must be greater than zero!")
+        sys.exit(err_stat['opt'])
+    elif opts.sleep_dur is not None and opts.sleep_dur < 0:
+        err("--sleep must not be negative!")
+        sys.exit(err_stat['opt'])
+    elif opts.api_rate <= 0 or opts.media_rate <= 0:
+        err("--api-rate and --media-rate must be greater than zero!")
+        sys.exit(err_stat['opt'])
+    elif opts.limit_rate is not None and opts.limit_rate <= 0:
+        err("--limit-rate must be greater than zero!")
+        sys.exit(err_stat['opt'])
+    elif opts.cache_ttl < 0 or opts.cache_size <= 0:
+        err("--cache-ttl and --cache-size must not be negative/zero!")
+        sys.exit(err_stat['opt'])
+    elif urlsplit(opts.api_url).scheme not in ("http", "https"):
+        err("--api-url must be an http(s) URL!")
+        sys.exit(err_stat['opt'])
+    elif opts.incremental is not None and opts.incremental <= 0:
+        err("--incremental must be greater than zero!")
+        sys.exit(err_stat['opt'])
+    elif opts.incremental and not opts.archive_file:
+        err("--incremental requires --use-archive!")
+        sys.exit(err_stat['opt'])
+    elif opts.incremental and opts.sort != "newest":
+        err("--incremental only works with the newest sort order!")
+        sys.exit(err_stat['opt'])
+    elif opts.retry_failed and not opts.state_file:
+        err("--retry-failed requires --state!")
+        sys.exit(err_stat['opt'])
+    elif opts.state_file and opts.out_file:
+        err("--state and --write-list are mutually exclusive!")
+        sys.exit(err_stat['opt'])
+    elif opts.dedup_root and opts.keep:
+        err("--dedup-root and --keep are mutually exclusive!")
+        sys.exit(err_stat['opt'])
+    elif opts.dedup_root and not os.path.isdir(opts.dedup_root):
+        err("--dedup-root must be an existing directory!")
+        sys.exit(err_stat['opt'])
 
-    if opts.dur:
-        command = ["ffmpeg", "-v", "quiet",
-                   "-f", "lavfi", "-i", "anullsrc",
-                   "-t", opts.dur, "-c", "copy",
-                   "-f", "null", "-"]
-        try:
-            subprocess.check_call(command)
-        except subprocess.CalledProcessError:
-            err("Invalid duration! For the supported syntax see:")
-            err("https://ffmpeg.org/ffmpeg-utils.html#time-duration-syntax")
-            sys.exit(err_stat['opt'])
+    # Output paths are relative to -p/--path
+    if opts.dedup_root:
+        opts.dedup_root = os.path.abspath(opts.dedup_root)
+
+    if opts.dur and not duration_syntax.fullmatch(opts.dur):
+        err("Invalid duration! For the supported syntax see:")
+        err("https://ffmpeg.org/ffmpeg-utils.html#time-duration-syntax")
+        sys.exit(err_stat['opt'])
 
     if opts.a_only and opts.v_only:
         err("--audio-only and --video-only are mutually exclusive!")
@@ -537,6 +2376,9 @@ def check_options():
         err("--share and --video-/audio-only are mutually exclusive!")
         sys.exit(err_stat['opt'])
 
+    if opts.out_format:
+        opts.out_template = compile_template(opts.out_format)
+
     allowed_sort = ["newest",
                     "oldest",
                     "newest_popular",
@@ -555,10 +2397,144 @@ def resolve_paths():
         os.mkdir(opts.path)
     os.chdir(opts.path)
 
-    if os.path.exists(opts.concat_list):
-        err("Error: Reserved filename ('", opts.concat_list, "') " \
-            "exists in '", opts.path, "'!", sep="")
-        sys.exit(err_stat['run'])
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def coub_id(link):
+    """Extract coub ID from a link (ignores scheme, query, trailing slashes, etc.)"""
+
+    path = urlsplit(link.strip()).path.rstrip("/")
+    if "/view/" in path:
+        return path.split("/view/")[-1].split("/")[0]
+    return path.split("/")[-1]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def api_json(url, cached=True):
+    """Request JSON from the Coub API, answered by the cache if possible"""
+
+    if cache and cached:
+        data = cache.get(url)
+        if data is not None:
+            return data
+
+    data = session.get_json(url)
+    if cache and cached:
+        cache.put(url, data)
+    return data
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def api_page(url):
+    """
+    Request a timeline page, returns errors instead of raising them
+
+    Pages get requested in the background (see prefetch), where a raised
+    error would also end the iteration for all following sources.
+    Timelines bypass the cache, a stale first page would hide new coubs
+    (e.g. from --incremental).
+    """
+
+    try:
+        return api_json(url, cached=False)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        return e
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def slim_metadata(data):
+    """Strip coub metadata down to what get_name/stream_lists need"""
+
+    keys = ("file_versions", "title", "created_at", "channel", "categories", "tags")
+    try:
+        return {k: data[k] for k in keys if k in data}
+    except TypeError:
+        return None
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def name_metadata(data):
+    """Strip coub metadata down to what get_name needs (or None)"""
+
+    try:
+        meta = {'title': data['title'],
+                'created_at': data['created_at'],
+                'channel': {'title': data['channel']['title']},
+                'tags': [{'title': t['title']} for t in data['tags']]}
+        if data.get('categories'):
+            meta['categories'] = [{'permalink': data['categories'][0]['permalink']}]
+    except (KeyError, TypeError, IndexError):
+        return None
+    return meta
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def complete_metadata(data):
+    """Check if coub metadata contains everything needed to download it"""
+
+    try:
+        versions = data['file_versions']
+        if not versions.get("share" if opts.share else "html5"):
+            return False
+        # Only custom output formatting needs more than the streams
+        if opts.out_format:
+            fields = (data['title'], data['created_at'], data['channel']['title'])
+            if not all(isinstance(f, str) for f in fields) or \
+               not isinstance(data['tags'], list):
+                return False
+    except (KeyError, TypeError, AttributeError):
+        return False
+
+    return True
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def compile_template(template):
+    """
+    Split an output name template into literal text and keywords
+
+    Keywords are returned as the part between the percent signs
+    (e.g. "title" for %title%). Happens once instead of for every coub.
+    """
+
+    parts = re.split("%(id|title|creation|category|channel|tags)%", template)
+    # Odd indices contain the captured keywords
+    return [(bool(i % 2), p) for i, p in enumerate(parts) if p]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def valid_name(name):
+    """Check if name is usable as filename without touching the disk"""
+
+    directory, base = os.path.split(name)
+    if not base or base in (".", ".."):
+        return False
+    if directory and not outputs.is_dir(directory):
+        return False
+
+    # Files always get an extension, so rules for the end of a filename
+    # (e.g. no trailing dots/spaces on Windows) never apply to the name itself
+    # Only outputs are named after it (intermediate files after the coub ID)
+    suffix = "_raw.mp4" if opts.keep else ".mp4"
+    longest = base + suffix
+    try:
+        if len(longest.encode(sys.getfilesystemencoding())) > 255:
+            return False
+    except UnicodeEncodeError:
+        return False
+
+    if os.name == "nt":
+        if any(c in name_invalid or ord(c) < 32 for c in base):
+            return False
+        # Windows ignores trailing spaces before the extension (CON .mp4)
+        if base.split(".")[0].rstrip(" ").upper() in name_reserved:
+            return False
+        # MAX_PATH
+        if len(os.path.abspath(name)) + len(suffix) >= 260:
+            return False
+    elif "\0" in base:
+        return False
+
+    return True
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -568,58 +2544,37 @@ def get_name(req_json, c_id):
     if not opts.out_format:
         return c_id
 
-    name = opts.out_format
-    name = name.replace("%id%", c_id)
-    name = name.replace("%creation%", req_json['created_at'])
-    name = name.replace("%channel%", req_json['channel']['title'])
-    # Coubs don't necessarily have a category
-    try:
-        name = name.replace("%category%", req_json['categories'][0]['permalink'])
-    except (KeyError, TypeError, IndexError):
-        name = name.replace("%category%", "")
-
-    tags = ""
-    for t in req_json['tags']:
-        tags += t['title'] + opts.tag_sep
-    name = name.replace("%tags%", tags)
-
-    # Strip/replace special characters that can lead to script failure (ffmpeg concat)
-    # ' common among coub titles
-    # Newlines can be occasionally found as well
-    title = req_json['title']
-    title = title.replace("'", "")
-    title = title.replace("\n", " ")
-    title = title.replace("\r", " ")
-    title = title.replace("/","")
-    title = title.replace("?","")
-    title = title.replace("|","")
-    title = title.replace("*","")
-    title = title.replace("<","")
-    title = title.replace(">","")
-    title = title.replace(")","")
-    title = title.replace("(","")
-    title = title.replace(":","")
-    title = title.replace("\\","")
-    title = title.replace("\"","")
-	
-    # Insert actual sanitized title
-    name = name.replace("%title%", title)
-	
+    values = {}
+    for is_key, key in opts.out_template:
+        if not is_key or key in values:
+            continue
+        if key == "id":
+            values[key] = c_id
+        elif key == "creation":
+            values[key] = req_json['created_at']
+        elif key == "channel":
+            values[key] = req_json['channel']['title']
+        elif key == "category":
+            # Coubs don't necessarily have a category
+            try:
+                values[key] = req_json['categories'][0]['permalink']
+            except (KeyError, TypeError, IndexError):
+                values[key] = ""
+        elif key == "tags":
+            values[key] = "".join(t['title'] + opts.tag_sep for t in req_json['tags'])
+        elif key == "title":
+            # Strip/replace special characters that can lead to script failure
+            values[key] = req_json['title'].translate(title_table)
+
+    name = "".join(values[p] if is_key else p for is_key, p in opts.out_template)
+
     # First try the original filename
-    try:
-        f = open(name, "w")
-        f.close()
-        os.remove(name)
-    except Exception:
+    if not valid_name(name):
         err("Warning: Filename has some unsupported characters, trying to fix that. ", end="")
         name = ''.join([i if ord(i) < 128 else '_' for i in name]).replace("?","")
         err("Trying '", name, "'.", sep="")
         # Try second time with sanitized filenames
-        try:
-            f = open(name, "w")
-            f.close()
-            os.remove(name)
-        except OSError:
+        if not valid_name(name):
             # Fallback to ID
             err("Error: Filename invalid or too long! ", end="")
             err("Falling back to '", c_id, "'.", sep="")
@@ -642,7 +2597,7 @@ def exists(name):
         full_name = [name + ".mp4"]
 
     for f in full_name:
-        if os.path.exists(f):
+        if outputs.exists(f):
             return True
 
     return False
@@ -655,27 +2610,123 @@ def overwrite():
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def read_archive(c_id):
-    """Check archive file for coub ID"""
+@contextmanager
+def locked(f):
+    """Hold an exclusive lock on an open file"""
+
+    # Windows locks byte ranges, use one far beyond any real content
+    offset = 2**31
+
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    elif msvcrt:
+        pos = f.tell()
+        f.seek(offset)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                # LK_LOCK gives up after 10 seconds
+                continue
+        f.seek(pos)
 
-    if not os.path.exists(opts.archive_file):
+    try:
+        yield f
+        f.flush()
+    finally:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        elif msvcrt:
+            f.seek(offset)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def clone(source, target):
+    """
+    Hardlink source to target, returns how the file got there
+
+    Falls back to a reflink (Linux only) or a plain copy if hardlinks
+    aren't possible (e.g. across filesystems).
+    """
+
+    try:
+        os.link(source, target)
+        return "hardlink"
+    except FileExistsError:
+        raise
+    except OSError:
+        pass
+
+    tmp_name = target + ".part"
+    temp_files.add(tmp_name)
+    try:
+        with open(source, "rb") as src, open(tmp_name, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), fcntl.FICLONE, src.fileno())
+                method = "reflink"
+            except (AttributeError, OSError):
+                shutil.copyfileobj(src, dst)
+                method = "copy"
+        os.replace(tmp_name, target)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        temp_files.discard(tmp_name)
+
+    return method
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def dedup_link(c_id, stats):
+    """Link a coub saved elsewhere below --dedup-root, returns success"""
+
+    found = dedup.find(c_id)
+    if not found:
         return False
+    source, size, meta = found
 
-    with open(opts.archive_file, "r") as f:
-        content = f.readlines()
-    for l in content:
-        if l == c_id + "\n":
-            return True
+    try:
+        name = get_name(meta, c_id)
+    except (KeyError, TypeError):
+        # Entry lacks the metadata custom output formatting needs
+        return False
+    target = name + os.path.splitext(source)[1]
+    if outputs.exists(target) or not stats.reserve(name, c_id):
+        return False
 
-    return False
+    try:
+        method = clone(source, target)
+    except OSError as e:
+        err("Warning: Couldn't link '", source, "' (", e, ")!", sep="")
+        return False
+
+    msg("Linked from '", os.path.relpath(source, dedup.root), "' (", method, ")", sep="")
+    stats.claim(c_id)
+    stats.add(done=1, linked=1, saved=size)
+    count("saved", size)
+    outputs.add(target)
+    if opts.out_format:
+        outputs.remember(c_id, name)
+    if opts.archive_file:
+        write_archive(c_id)
+    mark(c_id, JobState.downloaded)
+    return True
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def write_archive(c_id):
-    """Output coub ID to archive file"""
+def read_archive(c_id):
+    """Check archive for coub ID"""
+    with timed("archive"):
+        return c_id in archive
 
-    with open(opts.archive_file, "a") as f:
-        print(c_id, file=f)
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def write_archive(c_id):
+    """Output coub ID to archive"""
+    with timed("archive"):
+        archive.add(c_id)
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -775,84 +2826,381 @@ def stream_lists(data):
     return (video, audio)
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-def download_with_retry(v_link, a_link, a_ext, name, iteration=0):
+def download_with_retry(v_link, a_link, a_ext, name, pipe_audio=False, iteration=0):
     try:
-        download(v_link, a_link, a_ext, name)
+        download(v_link, a_link, a_ext, name, pipe_audio)
     except Exception:
         if iteration < 2:
             iteration += 1
-            download_with_retry(v_link, a_link, a_ext, name, iteration)
+            count("retries")
+            download_with_retry(v_link, a_link, a_ext, name, pipe_audio, iteration)
         else:
             raise
 
-def download(v_link, a_link, a_ext, name):
-    """Download individual coub streams"""
+def download(v_link, a_link, a_ext, name, pipe_audio=False):
+    """Download individual coub streams (audio only if it doesn't get piped)"""
 
-    """Randomize user agent a bit"""
-    n1 = random.randint(3000,4600)
-    n2 = random.randint(500,600)
-    n3 = random.randint(80,100)
-    agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/{1}.43 (KHTML, like Gecko) Chrome/{2}.0.{0}.82 Safari/537.36 OPR/79.0.4143.56'.format(n1, n2, n3)
-    opener = urllib.request.build_opener()
-    opener.addheaders = [('User-agent', agent)]
-    urllib.request.install_opener(opener)
+    # Video that gets merged with audio later on isn't the final output yet
+    if not opts.v_only and not opts.a_only and a_link:
+        v_name = name + "_raw.mp4"
+    else:
+        v_name = name + ".mp4"
 
-    if not opts.a_only:
+    # Streams only get their final name once complete,
+    # so retries can skip what has already been downloaded
+    if not opts.a_only and not os.path.exists(v_name):
         try:
-            urlretrieve(v_link, name + ".mp4")
+            with timed("video"):
+                session.retrieve(v_link, v_name)
         except (IndexError, urllib.error.HTTPError):
             err("Error: Coub unavailable!")
             raise
 
-    if not opts.v_only and a_link:
+    if not opts.v_only and a_link and not pipe_audio and \
+       not os.path.exists(name + "." + a_ext):
         try:
-            urlretrieve(a_link, name + "." + a_ext)
-        except (IndexError, urllib.error.HTTPError):
+            with timed("audio"):
+                session.retrieve(a_link, name + "." + a_ext)
+        except urllib.error.HTTPError as e:
             if opts.a_only:
                 err("Error: Audio or coub unavailable!")
                 raise
+            # Missing audio file -> merge keeps the video without sound
+            # Saving a silent coub on a server error would be permanent
+            if e.code not in gone_status:
+                raise
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def merge(a_ext, name):
-    """Merge video/audio stream with ffmpeg and loop video"""
+def merge(a_ext, temp, name, a_stream=None):
+    """
+    Merge video/audio stream with ffmpeg and loop video
+
+    Streams are read from temp_raw.mp4 and temp.a_ext, the result is
+    saved as name.mp4. a_stream is an HTTP response with the audio to
+    pipe into FFmpeg, otherwise the audio gets read from its file.
+    """
+
+    output_ext = ".mp4"
+    raw_name = temp + "_raw" + output_ext
+    a_name = temp + "." + a_ext
+
+    # Keep the video without sound if the audio was unavailable
+    if a_stream is None and not os.path.exists(a_name):
+        os.replace(raw_name, name + output_ext)
+        return
 
     err("file '" + name + ".mp4'", sep="")
-    # Print .txt for ffmpeg's concat
-    with open(opts.concat_list, "w") as f:
-        for i in range(opts.repeat):
-            print("file '" + name + ".mp4'", file=f)
 
     # Loop footage until shortest stream ends
-    # Concatenated video (via list) counts as one long stream
+    # -stream_loop seeks back within the same input instead of
+    # reopening the video for each repetition (like a concat list would)
+    # (which is also why only the audio can come from a pipe)
     command = ["ffmpeg", "-y", "-v", "error",
-               "-f", "concat", "-safe", "0",
-               "-i", opts.concat_list, "-i", name + "." + a_ext]
+               "-stream_loop", str(opts.repeat - 1), "-i", raw_name]
+    if a_stream is None:
+        command.extend(["-i", a_name])
+    else:
+        command.extend(["-f", a_ext, "-i", "pipe:0"])
 
     if opts.dur:
         command.extend(["-t", opts.dur])
 
-    output_ext = ".mp4"
-    tmp_name = name + "_" + output_ext
+    tmp_name = temp + "_" + output_ext
     command.extend(["-c", "copy", "-shortest", tmp_name])
 
-    subprocess.run(command)
-
+    temp_files.add(tmp_name)
+    try:
+        with ffmpeg_wait("merge"):
+            if a_stream is None:
+                result = subprocess.run(command, stderr=subprocess.PIPE,
+                                        universal_newlines=True, errors="replace")
+                code, messages = result.returncode, result.stderr
+            else:
+                code, messages = run_piped(command, a_stream)
+        # Streams stay around, so the next run can try again without downloading
+        if code:
+            raise subprocess.CalledProcessError(code, command, stderr=messages)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        temp_files.discard(tmp_name)
+        raise
+    if messages:
+        err(messages, end="")
+
+    # Raw video stays as name_raw.mp4 with --keep
     if not opts.keep:
-        os.remove(name + output_ext)
-        os.remove(name + "." + a_ext)
-    else:
-        os.replace(name + output_ext, name + "_raw" + output_ext)
-        
+        os.remove(raw_name)
+        if a_stream is None:
+            os.remove(a_name)
+    elif temp != name:
+        os.replace(raw_name, name + "_raw" + output_ext)
+        os.replace(a_name, name + "." + a_ext)
+
     os.replace(tmp_name, name + output_ext)
+    temp_files.discard(tmp_name)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def pipe_closed(e):
+    """Check if an error means the reading end of a pipe has exited"""
+    # Windows reports EINVAL instead (see subprocess.Popen._stdin_write)
+    return isinstance(e, BrokenPipeError) or \
+           (isinstance(e, OSError) and e.errno == errno.EINVAL)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def run_piped(command, resp):
+    """Run FFmpeg with the body of resp as input, returns (exit code, stderr)"""
+
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    # A full stderr pipe would block FFmpeg while we block on stdin
+    messages = []
+    reader = threading.Thread(target=lambda: messages.append(proc.stderr.read()),
+                              daemon=True)
+    reader.start()
+
+    try:
+        received = session.copy(resp, proc.stdin)
+        length = resp.getheader("Content-Length")
+        if length and length.isdigit() and received != int(length):
+            raise http.client.IncompleteRead(b"", int(length) - received)
+    except BaseException as e:
+        # FFmpeg stops reading once the output is complete (e.g. with -t)
+        if not pipe_closed(e):
+            # Closing stdin now would make a cut off stream look complete
+            proc.kill()
+            raise
+    finally:
+        try:
+            proc.stdin.close()
+        except OSError as e:
+            if not pipe_closed(e):
+                raise
+        proc.wait()
+        reader.join()
+
+    return (proc.returncode, messages[0].decode("utf-8", "replace") if messages else "")
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def merge_piped(a_link, a_ext, temp, name):
+    """Merge with the audio piped straight from the server (--stream-merge)"""
+
+    # A run without --stream-merge may have left the complete audio file
+    if os.path.exists(temp + "." + a_ext):
+        merge(a_ext, temp, name)
+        return
+
+    for attempt in range(3):
+        try:
+            resp = session.open(a_link)
+        except urllib.error.HTTPError as e:
+            # Handled like a missing audio file (see download)
+            if e.code in gone_status:
+                merge(a_ext, temp, name)
+                return
+            if attempt == 2:
+                raise
+            count("retries")
+            continue
+        try:
+            merge(a_ext, temp, name, resp)
+            return
+        except (OSError, http.client.HTTPException):
+            if attempt == 2:
+                raise
+            count("retries")
+        finally:
+            session.release(resp)
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 def clean():
     """Clean workspace"""
 
-    if os.path.exists(opts.concat_list):
-        os.remove(opts.concat_list)
+    for f in list(temp_files):
+        if os.path.exists(f):
+            os.remove(f)
+        temp_files.discard(f)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def fetch_coub(job, stats):
+    """Request coub metadata and decide what to download (1st stage)"""
+
+    msg("  ", job.count, " (", job.link, ")", sep="")
+
+    c_id = job.c_id
+    if metrics:
+        metrics.bind(c_id)
+
+    # Coubs already saved in another output directory get linked
+    # Comes first, as the archive is usually shared by all directories
+    if dedup and dedup_link(c_id, stats):
+        return False
+
+    # Pass existing files to avoid unnecessary downloads
+    # This check handles archive file search and default output formatting
+    # Avoids json request (slow!) just to skip files anyway
+    # Parallel jobs also skip IDs another job already took care of
+    if (opts.archive_file and read_archive(c_id)) or \
+       (not opts.out_format and exists(c_id) and not overwrite()) or \
+       not stats.claim(c_id):
+        msg("Already downloaded!")
+        stats.add(skipped=1)
+        mark(c_id, JobState.downloaded)
+        return False
+
+    # Custom output formatting usually needs metadata to know the name,
+    # unless the coub has been downloaded before
+    if opts.out_format and not overwrite():
+        name = outputs.guess(c_id)
+        if name and exists(name):
+            msg("Already downloaded!")
+            stats.add(done=1, skipped=1)
+            mark(c_id, JobState.downloaded)
+            if opts.archive_file:
+                write_archive(c_id)
+            return False
+
+    # Timeline responses already come with the needed metadata
+    req_json = job.data
+    if not complete_metadata(req_json):
+        req = opts.api_url + "/api/v2/coubs/" + c_id
+        try:
+            with timed("api"):
+                req_json = api_json(req)
+        except urllib.error.HTTPError:
+            err("Error: Coub unavailable!")
+            stats.add(unavailable=1)
+            mark(c_id, JobState.unavailable)
+            return False
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            # Network errors (or a cut off response) shouldn't end the whole run
+            err("Error: Failed to request metadata of coub ", c_id, " (", e, ")!", sep="")
+            stats.add(failed=1)
+            mark(c_id, JobState.failed)
+            return False
+        job.data = req_json
+
+    job.name = get_name(req_json, c_id)
+    # Long names only have to fit the outputs, not e.g. name_raw.mp4.part.src
+    job.temp = os.path.join(os.path.dirname(job.name), c_id)
+
+    # Get link list and assign final download URL
+    v_list, a_list = stream_lists(req_json)
+    try:
+        job.v_link = v_list[opts.v_quality]
+    except IndexError:
+        try:
+            msg("Warning: Target quality not found, tring to fallback to best available.")
+            job.v_link = v_list[-1]
+        except IndexError:
+            err("Error: Coub unavailable!")
+            mark(c_id, JobState.unavailable)
+            return False
+
+    try:
+        job.a_link = a_list[opts.a_quality]
+        # Audio can be MP3 (.mp3) or AAC (.m4a)
+        job.a_ext = job.a_link.split(".")[-1]
+        job.pipe_audio = opts.stream_merge and job.a_ext == "mp3" and \
+                         not (opts.keep or opts.v_only or opts.a_only)
+    except IndexError:
+        if opts.a_only:
+            err("Error: Audio or coub unavailable!")
+            stats.add(unavailable=1)
+            mark(c_id, JobState.unavailable)
+            return False
+
+    # Another check for custom output formatting
+    # Far slower to skip existing files (archive usage is recommended)
+    # Names taken by a coub that's still in progress count as existing
+    if opts.out_format and (exists(job.name) or not stats.reserve(job.name, c_id)) and \
+       not overwrite():
+        msg("Already downloaded!")
+        stats.add(done=1, skipped=1)
+        mark(c_id, JobState.downloaded)
+        outputs.remember(c_id, job.name)
+        if opts.archive_file:
+            write_archive(c_id)
+        return False
+
+    return True
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def download_coub(job, stats):
+    """Download the coub's video/audio streams (2nd stage)"""
+
+    if metrics:
+        metrics.bind(job.c_id)
+
+    # Skip if the requested media couldn't be downloaded
+    try:
+        download_with_retry(job.v_link, job.a_link, job.a_ext, job.temp, job.pipe_audio)
+    except Exception:
+        err("Error: Failed to download coub ", job.c_id, "!", sep="")
+        stats.add(failed=1)
+        mark(job.c_id, JobState.failed)
+        return False
+
+    return True
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def finish_coub(job, stats):
+    """Merge video/audio and record the download (3rd stage)"""
+
+    if metrics:
+        metrics.bind(job.c_id)
+
+    if opts.a_only:
+        output = job.name + "." + job.a_ext
+    else:
+        output = job.name + ".mp4"
+
+    try:
+        if not opts.v_only and not opts.a_only and job.a_link:
+            with timed("merge"):
+                if job.pipe_audio:
+                    merge_piped(job.a_link, job.a_ext, job.temp, job.name)
+                else:
+                    merge(job.a_ext, job.temp, job.name)
+        elif job.temp != job.name:
+            # Single stream that only needs its final name
+            os.replace(job.temp + output[len(job.name):], output)
+    except subprocess.CalledProcessError as e:
+        err("Error: Failed to merge coub ", job.c_id,
+            " (FFmpeg exit code ", e.returncode, ")!", sep="")
+        if e.stderr:
+            err(e.stderr.strip())
+        stats.add(failed=1)
+        mark(job.c_id, JobState.failed)
+        return False
+    except (OSError, http.client.HTTPException) as e:
+        # File errors or (with --stream-merge) the audio download failed
+        err("Error: Failed to merge coub ", job.c_id, " (", e, ")!", sep="")
+        stats.add(failed=1)
+        mark(job.c_id, JobState.failed)
+        return False
+
+    outputs.add(output)
+    if dedup:
+        dedup.add(job.c_id, output, name_metadata(job.data))
+    if opts.out_format:
+        outputs.remember(job.c_id, job.name)
+
+    # Write downloaded coub to archive
+    if opts.archive_file:
+        write_archive(job.c_id)
+
+    # Record successful download
+    stats.add(done=1)
+    mark(job.c_id, JobState.downloaded)
+    return True
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Main Function
@@ -860,118 +3208,233 @@ def clean():
 
 def main():
     """Main function body"""
+    global profiler
 
-    check_prereq()
     parse_cli()
+    if opts.serve:
+        serve()
+        return
+    if not opts.profile_file:
+        run()
+        return
+
+    profiler = Profiler()
+    try:
+        profiler.call(run)
+    finally:
+        profiler.write(opts.profile_file, opts.profile_top)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def run():
+    """Process all coubs specified on the command line"""
+    global archive, cache, outputs, dedup, metrics, checkpoint
+
     check_options()
+    # Only downloads need FFmpeg
+    if not opts.out_file:
+        check_prereq()
     resolve_paths()
 
-    msg("\n### Parse Input ###\n")
-    coubs.parse_input()
-
-    msg("\n### Download Coubs ###\n")
-    count = 0
-    done = 0
-    skipped = 0
-    unavailable = 0
-    for c in coubs.parsed:
-        count += 1
-        msg("  ", count, " out of ", len(coubs.parsed), " (", c, ")", sep="")
-
-        c_id = c.split("/")[-1]
-
-        # Pass existing files to avoid unnecessary downloads
-        # This check handles archive file search and default output formatting
-        # Avoids json request (slow!) just to skip files anyway
-        if (opts.archive_file and read_archive(c_id)) or \
-           (not opts.out_format and exists(c_id) and not overwrite()):
-            msg("Already downloaded!")
-            skipped += 1
-            clean()
-            continue
+    if opts.metrics_file:
+        metrics = Metrics()
+
+    outputs = OutputIndex(opts.out_format)
+    if opts.archive_file:
+        with timed("archive"):
+            archive = reuse(Archive, opts.archive_file)
+    cache = None
+    if opts.cache_dir:
+        cache = reuse(MetaCache, opts.cache_dir, opts.cache_ttl, opts.cache_size)
+    dedup = None
+    if opts.dedup_root:
+        dedup = reuse(DedupIndex, opts.dedup_root)
+
+    # An explicit pause is a hard limit (e.g. to avoid getting banned),
+    # the limiter may only slow down further on throttling
+    api_rate = opts.api_rate
+    if opts.sleep_dur:
+        api_rate = 1 / opts.sleep_dur
+    session.api_host = urlsplit(opts.api_url).netloc
+    session.api_limiter = RateLimiter(api_rate, api_rate)
+    session.media_limiter = RateLimiter(opts.media_rate, opts.media_rate)
+    session.bandwidth = None
+    if opts.limit_rate:
+        session.bandwidth = BandwidthLimiter(opts.limit_rate)
+
+    if opts.out_file:
+        msg("\n### Parse Input ###\n")
+        coubs.write_list()
+        clean()
+        if metrics:
+            metrics.write(opts.metrics_file)
+        sys.exit(0)
 
-        req = "https://coub.com/api/v2/coubs/" + c_id
+    if opts.state_file:
         try:
-            req_json = urlopen(req).read()
-        except urllib.error.HTTPError:
-            err("Error: Coub unavailable!")
-            unavailable += 1
-            continue
-        req_json = json.loads(req_json)
+            checkpoint = JobState(opts.state_file, coubs.inputs(), opts.retry_failed)
+        except ValueError:
+            err("Error: No job with the same input found in '", opts.state_file, "'!", sep="")
+            sys.exit(err_stat['opt'])
+        except OSError as e:
+            err("Error: Couldn't open state file (", e, ")!", sep="")
+            sys.exit(err_stat['opt'])
 
-        name = get_name(req_json, c_id)
+    # Links get parsed while the first coubs are already downloading
+    msg("\n### Parse Input & Download Coubs ###\n")
+    stats = RunStats()
+    pipeline = Pipeline([(fetch_coub, opts.meta_jobs),
+                         (download_coub, opts.jobs),
+                         (finish_coub, opts.merge_jobs)], stats)
+    pipeline.run(CoubJob(link, i, data)
+                 for i, (link, data) in enumerate(coubs.parse_input(), 1))
+    clean()
+    if metrics:
+        metrics.write(opts.metrics_file, stats)
+    if checkpoint:
+        checkpoint.finish()
+
+    # A resumed job may have nothing left to do
+    if not coubs.parsed and not coubs.incomplete and \
+       not (checkpoint and checkpoint.resumed):
+        err("Error: No coub links specified!")
+        sys.exit(err_stat['opt'])
 
-        # Get link list and assign final download URL
-        v_list, a_list = stream_lists(req_json)
-        try:
-            v_link = v_list[opts.v_quality]
-        except IndexError:
+    msg("\n### Finished ###\n")
+    msg("Processed: ", stats.done, " Skipped: ", stats.skipped,
+        " Unavailable: ", stats.unavailable, end="")
+    if stats.failed:
+        msg("", " Failed: ", stats.failed, end="")
+    if stats.linked:
+        msg("", " Linked: ", stats.linked, " (" + format_size(stats.saved) + " saved)", end="")
+    if cache:
+        msg("", " Cache hits: ", cache.hits, " Cache misses: ", cache.misses, end="")
+    if session.api_limiter.throttled:
+        msg("", " Throttled: ", session.api_limiter.throttled, end="")
+    if session.bandwidth:
+        msg("", " Downloaded: ", format_size(session.bandwidth.total),
+            " (" + format_size(session.bandwidth.throughput()) + "/s)", end="")
+    msg("\n")
+
+    # Indicate failure if not all input coubs exist after execution
+    if stats.done < coubs.parsed or coubs.incomplete:
+        sys.exit(err_stat['down'])
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def event_sender(write):
+    """Return a function that writes events as JSON lines (thread-safe)"""
+
+    lock = threading.Lock()
+
+    def send(event):
+        line = json.dumps(event) + "\n"
+        with lock:
             try:
-                msg("Warning: Target quality not found, tring to fallback to best available.")
-                v_link = v_list[-1]
-            except IndexError:
-                err("Error: Coub unavailable!")
-                continue
+                write(line)
+            except OSError:
+                # Client went away, the job continues anyway
+                pass
 
-        try:
-            a_link = a_list[opts.a_quality]
-            # Audio can be MP3 (.mp3) or AAC (.m4a)
-            a_ext = a_link.split(".")[-1]
-        except IndexError:
-            if opts.a_only:
-                err("Error: Audio or coub unavailable!")
-                unavailable += 1
-                continue
-            a_link = None
-            a_ext = None
+    return send
 
-        # Another check for custom output formatting
-        # Far slower to skip existing files (archive usage is recommended)
-        if opts.out_format and exists(name) and not overwrite():
-            msg("Already downloaded!")
-            clean()
-            done += 1
-            skipped += 1
-            if opts.archive_file:
-                write_archive(c_id)
-            continue
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-        if opts.sleep_dur and count > 1:
-            time.sleep(opts.sleep_dur)
+def serve():
+    """
+    Run as job server (--serve)
+
+    A job is a JSON object per line with the command line arguments
+    (same options as usual) and optionally a working directory:
+      {"id": 1, "args": ["-l", "list.txt", "--use-archive", "a.txt"], "cwd": "C:\\Coubs"}
+    Jobs run one at a time, but archive indexes, HTTP connections and
+    metadata caches are kept between them. Progress gets reported as
+    JSON lines ("started", "coub" per processed coub and "finished"
+    with the exit code). Regular messages go to stderr.
+    """
+
+    # stdout is reserved for events
+    out = sys.stdout
+    sys.stdout = sys.stderr
+
+    if opts.serve == "-":
+        def write(line):
+            out.write(line)
+            out.flush()
+
+        send = event_sender(write)
+        for line in sys.stdin:
+            if line.strip():
+                serve_job(line, send)
+        return
 
-        # Download video/audio streams
-        # Skip if the requested media couldn't be downloaded
-        try:
-            download_with_retry(v_link, a_link, a_ext, name)
-        except Exception:
-            err("Error: Failed to download coub ", c_id, "!", sep="")
-            continue
+    try:
+        port = int(opts.serve)
+        server = JobServer(port)
+    except (ValueError, OverflowError, OSError) as e:
+        err("Error: Can't listen on '", opts.serve, "' (", e, ")!", sep="")
+        sys.exit(err_stat['opt'])
 
-        # Merge video and audio
-        if not opts.v_only and not opts.a_only and a_link:
-            merge(a_ext, name)
+    err("Listening on 127.0.0.1:", server.server_address[1], sep="")
+    with server:
+        server.serve_forever()
 
-        # Write downloaded coub to archive
-        if opts.archive_file:
-            write_archive(c_id)
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-        # Clean workspace
-        clean()
+def serve_job(line, send):
+    """Run a single server job, its progress gets reported through send"""
+    global opts, coubs, metrics, checkpoint, profiler, events
 
-        # Record successful download
-        done += 1
+    try:
+        request = json.loads(line)
+        job_id = request.get('id')
+        args = request['args']
+        cwd = request.get('cwd', os.getcwd())
+        if not all(isinstance(a, str) for a in args) or "--serve" in args:
+            raise TypeError
+    except (ValueError, KeyError, TypeError, AttributeError):
+        send({'event': "error", 'message': "Invalid job: " + line.strip()})
+        return
+
+    # Start from a clean slate, like a new process would
+    opts = Options()
+    coubs = CoubInputData()
+    metrics = checkpoint = profiler = None
+    states = {}
 
-    msg("\n### Finished ###\n")
-    msg("Processed: ", done, " Skipped: ", skipped, " Unavailable: ", unavailable, "\n")
+    def progress(c_id, state):
+        states[state] = states.get(state, 0) + 1
+        send({'job': job_id, 'event': "coub", 'id': c_id, 'state': state})
 
-    # Indicate failure if not all input coubs exist after execution
-    if done < count:
-        sys.exit(err_stat['down'])
+    events = progress
+    server_dir = os.getcwd()
+    argv = sys.argv
+    sys.argv = [argv[0]] + args
+    send({'job': job_id, 'event': "started"})
+
+    code = 0
+    try:
+        os.chdir(cwd)
+        main()
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else err_stat['run']
+    except Exception as e:
+        # A broken job shouldn't take down the server
+        err("Error: ", repr(e), sep="")
+        code = err_stat['run']
+    finally:
+        clean()
+        events = None
+        sys.argv = argv
+        os.chdir(server_dir)
+
+    send({'job': job_id, 'event': "finished", 'exit_code': code, 'states': states})
 
 # Execute main function
 if __name__ == '__main__':
     opts = Options()
     coubs = CoubInputData()
+    session = HttpSession()
 
     try:
         main()